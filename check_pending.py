@@ -171,6 +171,7 @@ def create_test_diario(db):
         "user_name": "TESTE TRANSCRIÇÃO",
         "date_formatted": "03/10/2025",
         "audio_messages": 2,
+        "has_audio": True,  # Flag indexada usada na busca de pendentes
         "media_messages": 1,
         "status_audios": "pending",  # Status pendente
         "contacts": [
@@ -186,6 +186,20 @@ def cleanup_failed():
     except Exception as e:
         print(f"❌ Erro na limpeza: {e}")
 
+def refresh_flags():
+    """Recalcular flags has_audio (migração / manutenção)"""
+    print("🏷️ Recalculando flags has_audio...")
+    
+    try:
+        from src.services.database_service import DatabaseService
+        db = DatabaseService()
+        flagged = db.refresh_audio_flags()
+        print(f"✅ {flagged} conversas marcadas com has_audio")
+        db.close()
+        
+    except Exception as e:
+        print(f"❌ Erro ao recalcular flags: {e}")
+
 def start_api():
     """Iniciar API"""
     print("🌐 Iniciando API...")
@@ -233,6 +247,9 @@ def main():
     # Comando cleanup
     subparsers.add_parser('cleanup', help='Limpar conversas com erro')
     
+    # Comando refresh-flags
+    subparsers.add_parser('refresh-flags', help='Recalcular flag has_audio de todas as conversas')
+    
     # Comando api
     subparsers.add_parser('api', help='Iniciar API')
     
@@ -257,6 +274,8 @@ def main():
         discover_pending()
     elif args.command == 'cleanup':
         cleanup_failed()
+    elif args.command == 'refresh-flags':
+        refresh_flags()
     elif args.command == 'api':
         start_api()
     else:
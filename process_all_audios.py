@@ -143,11 +143,14 @@ def process_all_pending_audios(limit=None, dry_run=False, force=False):
                 else:
                     print(f"   🎵 Encontrados {len(pending_audios)} áudios pendentes")
                 
-                # Processar cada áudio
+                # Processar cada áudio (collection de transcrições gravada em lote por conversa)
                 conv_successful = 0
                 conv_failed = 0
+                pending_collection = []
                 
-                for j, audio_msg in enumerate(pending_audios, 1):
+                # Downloads dos próximos áudios em paralelo com a transcrição do atual
+                audio_stream = download_service.prefetch_audio_messages(pending_audios)
+                for j, audio_msg in enumerate(audio_stream, 1):
                     message_id = audio_msg['message_id']
                     contact_name = audio_msg.get('contact_name', 'Desconhecido')
                     
@@ -158,7 +161,8 @@ def process_all_pending_audios(limit=None, dry_run=False, force=False):
                         audio_msg, 
                         download_service, 
                         db_service, 
-                        show_progress=True
+                        show_progress=True,
+                        pending_collection=pending_collection
                     )
                     
                     if result['success']:
@@ -166,6 +170,8 @@ def process_all_pending_audios(limit=None, dry_run=False, force=False):
                     else:
                         conv_failed += 1
                 
+                audio_service.save_transcriptions_to_collection(pending_collection, db_service)
+                
                 print(f"   📊 Resultado: {conv_successful} sucessos, {conv_failed} falhas")
                 
                 total_processed += len(pending_audios)
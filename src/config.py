@@ -14,10 +14,21 @@ class Config:
     # MongoDB
     MONGODB_URI = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
     MONGODB_DATABASE = os.getenv("MONGODB_DATABASE", "dashboard_whatsapp")
+    MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+    MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "10"))
+    MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "60000"))
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+    MONGODB_COMPRESSORS = os.getenv("MONGODB_COMPRESSORS", "zstd,zlib")
+    STATS_TTL_SECONDS = int(os.getenv("STATS_TTL_SECONDS", "30"))
+    CONVERSATION_CACHE_TTL_SECONDS = int(os.getenv("CONVERSATION_CACHE_TTL_SECONDS", "60"))
+    CONVERSATION_CACHE_MAX_ENTRIES = int(os.getenv("CONVERSATION_CACHE_MAX_ENTRIES", "256"))
     
     # Whisper
     WHISPER_MODEL = os.getenv("WHISPER_MODEL", "medium")
     WHISPER_LANGUAGE = os.getenv("WHISPER_LANGUAGE", "pt")
+    WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "auto")
+    WHISPER_WORD_TIMESTAMPS = os.getenv("WHISPER_WORD_TIMESTAMPS", "false").lower() == "true"
+    WHISPER_HIGH_QUALITY = os.getenv("WHISPER_HIGH_QUALITY", "false").lower() == "true"
     
     # GPU Settings
     GPU_BATCH_SIZE = int(os.getenv("GPU_BATCH_SIZE", "4"))
@@ -30,6 +41,12 @@ class Config:
     # Ollama
     OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
     OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5:7b")
+    OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "8192"))
+    OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "-1")
+    OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+    LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "604800"))
+    CONTACT_MIN_MESSAGES = int(os.getenv("CONTACT_MIN_MESSAGES", "3"))
+    CONTACT_MIN_TEXT_CHARS = int(os.getenv("CONTACT_MIN_TEXT_CHARS", "200"))
     
     # Paths
     BASE_DIR = Path(__file__).parent.parent
@@ -119,25 +119,19 @@ class SimpleQueueManager:
             # 2. Processar áudios (download + transcrição)
             transcription_results = self.audio_processor.process_audio_batch(audio_urls)
             
-            # 3. Salvar transcrições no MongoDB
-            successful_transcriptions = 0
-            failed_transcriptions = 0
-            
-            for audio_info, transcription in transcription_results:
-                if transcription:
-                    success = self.db.update_audio_transcription(
-                        conversation_id,
-                        audio_info['contact_idx'],
-                        audio_info['message_idx'],
-                        transcription
-                    )
-                    
-                    if success:
-                        successful_transcriptions += 1
-                    else:
-                        failed_transcriptions += 1
-                else:
-                    failed_transcriptions += 1
+            # 3. Salvar transcrições no MongoDB (um único bulk_write para a conversa)
+            updates = [
+                {
+                    'conversation_id': conversation_id,
+                    'contact_idx': audio_info['contact_idx'],
+                    'message_idx': audio_info['message_idx'],
+                    'transcription': transcription
+                }
+                for audio_info, transcription in transcription_results
+                if transcription
+            ]
+            successful_transcriptions = self.db.update_audio_transcriptions(updates)
+            failed_transcriptions = len(audio_urls) - successful_transcriptions
             
             # 4. Atualizar resumo de transcrições
             self.db.update_audio_transcriptions_summary(conversation_id)
@@ -226,13 +220,15 @@ class SimpleQueueManager:
         """Obter status do processamento"""
         try:
             # Contar conversas por status
-            conversations = self.db.get_conversations_with_pending_audios(10000)
+            conversations = self.db.iter_conversations_with_pending_audios(10000)
             
             status_counts = {}
+            total_conversations = 0
             total_audios = 0
             total_transcribed = 0
             
             for conv in conversations:
+                total_conversations += 1
                 status = conv.get('status_audios', 'unknown')
                 status_counts[status] = status_counts.get(status, 0) + 1
                 
@@ -249,7 +245,7 @@ class SimpleQueueManager:
                 'processing_active': self.processing_active,
                 'max_workers': self.max_workers,
                 'conversations_by_status': status_counts,
-                'total_conversations': len(conversations),
+                'total_conversations': total_conversations,
                 'total_audios_pending': total_audios,
                 'total_audios_transcribed': total_transcribed,
                 'transcription_progress': (total_transcribed / (total_audios + total_transcribed) * 100) if (total_audios + total_transcribed) > 0 else 0,
@@ -274,7 +270,7 @@ class SimpleQueueManager:
             cutoff_time = datetime.now() - timedelta(hours=max_age_hours)
             
             # Buscar conversas com erro antigas
-            conversations = self.db.get_conversations_with_pending_audios(10000)
+            conversations = self.db.iter_conversations_with_pending_audios(10000)
             failed_conversations = [
                 conv for conv in conversations
                 if conv.get('status_audios') == 'error' and 
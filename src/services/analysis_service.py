@@ -2,24 +2,276 @@
 Service para interação com Llama/Ollama
 """
 import requests
+from requests.adapters import HTTPAdapter
+import hashlib
 import json
+import re
+import threading
 import time
+from collections import Counter
+from string import Template
 from typing import Dict, List, Optional, Any
+from dataclasses import dataclass
 from datetime import datetime
 
 from .base_service import BaseService
 from ..config import Config
 
+# Padrão para extrair a primeira lista JSON de respostas com texto extra
+_JSON_ARRAY_RE = re.compile(r'\[.*?\]', re.DOTALL)
+
+
+def _flatten_strings(values: List[Any]):
+    """Achatar listas de strings (até um nível) ignorando itens que não são texto"""
+    for value in values:
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, list):
+            yield from (item for item in value if isinstance(item, str))
+
+
+@dataclass(frozen=True)
+class DiaryContext:
+    """Dados do diário usados nos prompts por contato (extraídos uma vez por diário)"""
+    user_name: str
+    company_name: str
+    date_formatted: str
+    
+    @classmethod
+    def from_diary(cls, diary_data: Dict) -> 'DiaryContext':
+        """Criar contexto a partir dos dados do diário"""
+        return cls(
+            user_name=diary_data.get('user_name', 'Usuário'),
+            company_name=diary_data.get('company_name', 'Empresa'),
+            date_formatted=diary_data.get('date_formatted', 'Data')
+        )
+
+
 class LlamaService(BaseService):
     """Service para interação com Llama via Ollama"""
     
+    # Timeout de conexão TCP (s); o timeout de leitura é definido por chamada
+    CONNECT_TIMEOUT = 5
+    
+    # Limite de tokens gerados por resposta
+    NUM_PREDICT = 1536
+    
+    # Requisições simultâneas ao Ollama no processo inteiro (pools aninhados
+    # de ContactAnalysisService não multiplicam a concorrência)
+    _ollama_slots = threading.BoundedSemaphore(max(1, Config.OLLAMA_NUM_PARALLEL))
+    
+    # Aproximação de tokens por palavra (português) usada no orçamento de contexto
+    TOKENS_PER_WORD = 1.5
+    
+    # Opções de amostragem por tipo de tarefa (classificação curta = determinística)
+    TASK_OPTIONS = {
+        "topics": {"temperature": 0.0, "top_p": 1.0, "num_predict": 120},
+        "sentiment": {"temperature": 0.0, "top_p": 1.0, "num_predict": 200},
+        "summary": {"temperature": 0.3, "num_predict": 400},
+        "insights": {"temperature": 0.4, "num_predict": 300},
+        # ContactAnalysisService: respostas estruturadas curtas
+        "contact_combined": {"temperature": 0.2, "num_predict": 1200},
+        "contact_json": {"temperature": 0.2, "num_predict": 512},
+        "contact_list": {"temperature": 0.2, "num_predict": 128},
+    }
+    
+    # Incluir o prompt completo nos resultados (debug); por padrão só o hash em erros
+    include_prompt_in_result: bool = False
+    
+    # Saída estruturada por tarefa (format=json do Ollama gera apenas objetos)
+    TASK_FORMATS = {
+        "sentiment": "json",
+    }
+    
+    # Prompts por contato: estrutura estática pré-carregada, apenas as variáveis são substituídas
+    _PROMPT_CONTACT_COMBINED = Template("""
+CONTEXTO DA ANÁLISE:
+Você está analisando uma conversa do WhatsApp Business de um dia de trabalho específico entre:
+- ${user_name} (funcionário da ${company_name})
+- ${contact_name} (cliente/lead)
+- Data: ${date_formatted}
+
+PROPÓSITO:
+Avaliar a qualidade do atendimento, a satisfação do cliente e oportunidades de venda.
+
+CONVERSA A SER ANALISADA:
+${conversation_text}
+
+INSTRUÇÕES:
+- Considere o contexto histórico para entender a evolução do relacionamento
+- Use transcrições de áudio e análises de imagem como conteúdo real
+- "summary": resumo objetivo do atendimento a ${contact_name}, com satisfação do cliente, efetividade de ${user_name}, oportunidades de venda, objeções e se o atendimento foi resolutivo
+- "topics": 3-5 tópicos de negócio (máximo 3 palavras cada)
+- "sentiment": sentimento do CLIENTE em relação ao atendimento
+- "insights": exatamente 3 insights comerciais acionáveis sobre ${contact_name}
+- Responda APENAS com JSON válido, sem markdown
+
+FORMATO OBRIGATÓRIO (JSON):
+{
+  "summary": "Resumo da conversa com ${contact_name}",
+  "topics": ["tópico1", "tópico2", "tópico3"],
+  "sentiment": {
+    "overall_sentiment": "positivo/negativo/neutro",
+    "confidence": 0.0-1.0,
+    "emotions": ["interesse", "satisfação", "dúvida", "frustração", etc],
+    "description": "Breve análise do sentimento comercial"
+  },
+  "insights": ["insight 1", "insight 2", "insight 3"]
+}
+
+Responda APENAS com o JSON:
+""")
+    
+    _PROMPT_CONTACT_SUMMARY = Template("""
+CONTEXTO DA ANÁLISE:
+Você está analisando uma conversa do WhatsApp Business de um dia de trabalho específico.
+
+DADOS DO USUÁRIO:
+- Nome: ${user_name}
+- Empresa: ${company_name}
+- Data: ${date_formatted}
+- Papel: Funcionário/Atendente da empresa
+
+DADOS DO CONTATO:
+- Nome: ${contact_name}
+- Papel: Cliente/Lead/Prospect da empresa
+- Relacionamento: Conversa comercial/profissional
+
+PROPÓSITO DA ANÁLISE:
+Esta análise faz parte de um sistema de inteligência empresarial que:
+1. Avalia a qualidade do atendimento ao cliente
+2. Identifica oportunidades de melhoria no relacionamento
+3. Extrai insights sobre necessidades dos clientes
+4. Monitora padrões de comunicação e vendas
+5. Gera feedback para treinamento e desenvolvimento
+
+CONVERSA A SER ANALISADA:
+${conversation_text}
+
+INSTRUÇÕES ESPECÍFICAS:
+- Analise a conversa do ponto de vista de atendimento ao cliente
+- Identifique o nível de satisfação do cliente ${contact_name}
+- Avalie a efetividade da comunicação de ${user_name}
+- Destaque oportunidades de venda ou upsell
+- Identifique problemas ou objeções do cliente
+- Avalie se o atendimento foi resolutivo
+- Considere o contexto histórico para entender a evolução do relacionamento
+- Use transcrições de áudio e análises de imagem como conteúdo real
+- Seja objetivo e focado em insights acionáveis
+
+Resumo da conversa com ${contact_name}:
+""")
+    
+    _PROMPT_CONTACT_TOPICS = Template("""
+CONTEXTO:
+Você está analisando uma conversa comercial do WhatsApp Business entre:
+- ${user_name} (funcionário da ${company_name})
+- ${contact_name} (cliente/lead)
+
+PROPÓSITO:
+Identificar os principais tópicos de negócio discutidos para categorização e análise de vendas.
+
+CONVERSA:
+${conversation_text}
+
+INSTRUÇÕES:
+- Identifique 3-5 tópicos principais relacionados a NEGÓCIOS/VENDAS/ATENDIMENTO
+- Foque em: produtos, serviços, preços, dúvidas, objeções, necessidades, problemas
+- Use palavras-chave comerciais (máximo 3 palavras por tópico)
+- Responda APENAS com JSON válido
+- NÃO inclua texto explicativo
+
+EXEMPLOS DE TÓPICOS COMERCIAIS:
+["produto", "preço", "desconto"]
+["dúvida", "especificação", "prazo"]
+["objeção", "concorrência", "custo"]
+["necessidade", "solução", "benefício"]
+
+Responda APENAS com o JSON:
+""")
+    
+    _PROMPT_CONTACT_SENTIMENT = Template("""
+CONTEXTO COMERCIAL:
+Você está analisando o sentimento de uma conversa de vendas/atendimento entre:
+- ${user_name} (funcionário da ${company_name})
+- ${contact_name} (cliente/lead)
+
+PROPÓSITO:
+Avaliar a satisfação do cliente e a efetividade do atendimento para melhorar o relacionamento comercial.
+
+CONVERSA:
+${conversation_text}
+
+INSTRUÇÕES:
+- Analise o sentimento do CLIENTE (${contact_name}) em relação ao atendimento
+- Avalie a efetividade da comunicação do FUNCIONÁRIO (${user_name})
+- Identifique sinais de satisfação, insatisfação, interesse ou desinteresse
+- Considere o contexto histórico para entender a evolução do relacionamento
+- Use transcrições de áudio e análises de imagem como conteúdo real
+- Foque em aspectos comerciais: interesse em comprar, confiança, objeções
+
+Responda em formato JSON:
+{
+  "overall_sentiment": "positivo/negativo/neutro",
+  "confidence": 0.0-1.0,
+  "emotions": ["interesse", "satisfação", "dúvida", "frustração", etc],
+  "description": "Breve análise do sentimento comercial"
+}
+
+Resposta (formato JSON):
+""")
+    
+    _PROMPT_CONTACT_INSIGHTS = Template("""
+CONTEXTO COMERCIAL:
+Você está analisando uma conversa de vendas/atendimento entre:
+- ${user_name} (funcionário da ${company_name})
+- ${contact_name} (cliente/lead)
+
+PROPÓSITO:
+Gerar insights acionáveis para melhorar vendas, atendimento e relacionamento com o cliente.
+
+CONVERSA:
+${conversation_text}
+
+INSTRUÇÕES:
+- Gere 3 insights COMERCIAIS específicos sobre ${contact_name}
+- Foque em: perfil do cliente, necessidades, objeções, oportunidades de venda
+- Identifique padrões de comportamento e preferências
+- Destaque sinais de interesse ou desinteresse
+- Compare com histórico para identificar evolução
+- Cada insight deve ser acionável para vendas/atendimento
+- Responda APENAS com JSON válido
+
+EXEMPLOS DE INSIGHTS COMERCIAIS:
+["Cliente demonstra alto interesse em produtos premium", "Sensibilidade a preços sugere foco em soluções econômicas", "Comunicação formal indica perfil B2B corporativo"]
+["Lead apresenta objeções sobre prazo de entrega", "Necessidade específica de customização identificada", "Sinal de interesse em proposta comercial"]
+
+Responda APENAS com o JSON:
+""")
+    
     def _initialize(self):
         """Inicializar service"""
         self.base_url = Config.OLLAMA_BASE_URL
         self.model = Config.OLLAMA_MODEL
+        
+        # Sessão HTTP compartilhada (keep-alive) para todas as chamadas ao Ollama.
+        # Pool do tamanho do limite de requisições simultâneas (_ollama_slots)
+        self._http = requests.Session()
+        pool_size = max(1, Config.OLLAMA_NUM_PARALLEL)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+        
+        # Manter modelo residente no Ollama (-1 = sem descarregar)
+        keep_alive = Config.OLLAMA_KEEP_ALIVE
+        self.keep_alive = int(keep_alive) if keep_alive.lstrip('-').isdigit() else keep_alive
+        
         self._test_connection()
+        self.num_ctx = self._get_context_length()
+        self._warm_up_model()
         
-        # Estatísticas de uso
+        # Estatísticas de uso (atualizadas por várias threads)
+        self._stats_lock = threading.Lock()
         self.usage_stats = {
             "total_requests": 0,
             "total_input_tokens": 0,
@@ -48,7 +300,7 @@ DIRETRIZES:
     def _test_connection(self):
         """Testar conexão com Ollama"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=5)
+            response = self._http.get(f"{self.base_url}/api/tags", timeout=(self.CONNECT_TIMEOUT, 5))
             response.raise_for_status()
             
             models = response.json().get('models', [])
@@ -62,6 +314,101 @@ DIRETRIZES:
         except Exception as e:
             self.logger.warning(f"⚠️ Ollama não disponível: {e}")
     
+    def _get_context_length(self) -> int:
+        """Obter janela de contexto efetiva (limitada pelo modelo via /api/show)"""
+        num_ctx = Config.OLLAMA_NUM_CTX
+        
+        try:
+            response = self._http.post(
+                f"{self.base_url}/api/show",
+                json={"model": self.model},
+                timeout=(self.CONNECT_TIMEOUT, 10)
+            )
+            response.raise_for_status()
+            
+            model_info = response.json().get('model_info', {})
+            for key, value in model_info.items():
+                if key.endswith('.context_length') and isinstance(value, int):
+                    num_ctx = min(num_ctx, value)
+                    break
+        except Exception as e:
+            self.logger.warning(f"⚠️ Não foi possível obter contexto do modelo, usando {num_ctx}: {e}")
+        
+        self.logger.info(f"📏 Janela de contexto: {num_ctx} tokens")
+        return num_ctx
+    
+    def _warm_up_model(self):
+        """Carregar modelo no Ollama antes da primeira análise (evita cold start)
+        
+        Usa o mesmo num_ctx de _call_ollama: um num_ctx diferente faz o Ollama recarregar o modelo.
+        """
+        try:
+            start_time = time.time()
+            response = self._http.post(
+                f"{self.base_url}/api/generate",
+                json={"model": self.model, "prompt": "", "keep_alive": self.keep_alive,
+                      "options": {"num_ctx": self.num_ctx}},
+                timeout=(self.CONNECT_TIMEOUT, 60)
+            )
+            response.raise_for_status()
+            self.logger.info(f"🔥 Modelo {self.model} carregado em {time.time() - start_time:.2f}s")
+        except Exception as e:
+            self.logger.warning(f"⚠️ Não foi possível pré-carregar o modelo: {e}")
+    
+    def _prompt_fields(self, prompt: str, error: bool = False) -> Dict[str, str]:
+        """Campos de prompt para o resultado (prompt completo só se habilitado)"""
+        if self.include_prompt_in_result:
+            return {"prompt": prompt}
+        if not error:
+            return {}
+        
+        prompt_hash = hashlib.blake2b(prompt.encode(), digest_size=8).hexdigest()
+        self.logger.debug(f"📝 Prompt com erro [{prompt_hash}]:\n{prompt}")
+        return {"prompt_hash": prompt_hash}
+    
+    def _estimate_tokens(self, text: str) -> int:
+        """Estimar número de tokens de um texto (aproximação por palavras)"""
+        return int(len(text.split()) * self.TOKENS_PER_WORD)
+    
+    def _fit_to_context(self, text: str, reserve: int = 800) -> str:
+        """Truncar texto para caber na janela de contexto
+        
+        Reserva espaço para o prompt/system prompt (reserve) e para a resposta
+        (NUM_PREDICT). Quando excede, mantém o início (cabeçalho e contexto
+        histórico) e as mensagens mais recentes, omitindo o meio.
+        """
+        budget = self.num_ctx - reserve - self.NUM_PREDICT
+        if budget <= 0 or self._estimate_tokens(text) <= budget:
+            return text
+        
+        lines = text.split('\n')
+        head_budget = budget // 4
+        
+        # Início: cabeçalho/contexto histórico
+        head = []
+        used = 0
+        for line in lines:
+            cost = self._estimate_tokens(line)
+            if used + cost > head_budget:
+                break
+            head.append(line)
+            used += cost
+        
+        # Fim: mensagens mais recentes
+        tail = []
+        for line in reversed(lines[len(head):]):
+            cost = self._estimate_tokens(line)
+            if used + cost > budget:
+                break
+            tail.append(line)
+            used += cost
+        tail.reverse()
+        
+        omitted = len(lines) - len(head) - len(tail)
+        self.logger.info(f"✂️ Conversa truncada para o contexto: {omitted} linhas omitidas")
+        
+        return '\n'.join(head + [f"[... {omitted} mensagens omitidas ...]"] + tail)
+    
     def analyze_conversation(self, conversation_data: Dict) -> Dict:
         """Analisar conversa completa (DEPRECATED - usar analyze_diary)"""
         self._log_operation("análise de conversa", {
@@ -78,6 +425,8 @@ DIRETRIZES:
             if not conversation_text.strip():
                 return {'error': 'Conversa sem conteúdo para análise'}
             
+            conversation_text = self._fit_to_context(conversation_text)
+            
             # Análise completa com prompts
             analysis = {
                 'summary': self._generate_summary_with_prompt(conversation_text),
@@ -112,31 +461,36 @@ DIRETRIZES:
             if not diary_data or not diary_data.get('contacts'):
                 return {'error': 'Dados de diário inválidos'}
             
+            diary_context = DiaryContext.from_diary(diary_data)
+            
             # 1. Analisar cada contato individualmente
             contact_analyses = []
             for contact_idx, contact in enumerate(diary_data.get('contacts', [])):
-                contact_analysis = self._analyze_contact(contact, diary_data, contact_idx)
+                contact_analysis = self._analyze_contact(contact, diary_data, contact_idx, diary_context)
                 if contact_analysis:
                     contact_analyses.append(contact_analysis)
             
             if not contact_analyses:
                 return {'error': 'Nenhuma análise de contato válida gerada'}
             
+            # Filtrado uma única vez e compartilhado entre resumo e estatísticas
+            successful_analyses = [ca for ca in contact_analyses if ca.get('success', False)]
+            
             # 2. Gerar resumo global do diário
-            diary_summary = self._generate_diary_summary(contact_analyses, diary_data)
+            diary_summary = self._generate_diary_summary(contact_analyses, diary_data, successful_analyses)
             
             # 3. Compilar resultado final
             result = {
                 'contact_analyses': contact_analyses,
                 'diary_summary': diary_summary,
-                'analysis_stats': self._calculate_analysis_stats(contact_analyses, diary_data),
+                'analysis_stats': self._calculate_analysis_stats(contact_analyses, diary_data, successful_analyses),
                 'analyzed_at': datetime.now().isoformat()
             }
             
             self._log_success("análise de diário", {
                 "diary_id": str(diary_data.get('_id')),
                 "contacts_analyzed": len(contact_analyses),
-                "analysis_success_rate": len([c for c in contact_analyses if c.get('success', False)]) / len(contact_analyses) * 100
+                "analysis_success_rate": len(successful_analyses) / len(contact_analyses) * 100
             })
             
             return result
@@ -226,7 +580,7 @@ Resumo:
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="summary")
             return response.strip()
         except Exception as e:
             self.logger.error(f"Erro ao gerar resumo: {e}")
@@ -258,17 +612,17 @@ Resumo:
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="summary")
             return {
                 "result": response.strip(),
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
             self.logger.error(f"Erro ao gerar resumo: {e}")
             return {
                 "result": "Erro ao gerar resumo",
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
@@ -291,7 +645,7 @@ Tópicos (formato JSON):
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="topics")
             try:
                 topics = json.loads(response.strip())
                 return topics if isinstance(topics, list) else [response.strip()]
@@ -335,7 +689,7 @@ Responda APENAS com o JSON:
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="topics")
             response_clean = response.strip()
             
             # Tentar parse JSON direto
@@ -347,8 +701,7 @@ Responda APENAS com o JSON:
                     result = [str(topics)]
             except json.JSONDecodeError:
                 # Tentar extrair JSON da resposta
-                import re
-                json_match = re.search(r'\[.*?\]', response_clean, re.DOTALL)
+                json_match = _JSON_ARRAY_RE.search(response_clean)
                 if json_match:
                     try:
                         topics = json.loads(json_match.group())
@@ -364,14 +717,14 @@ Responda APENAS com o JSON:
             
             return {
                 "result": result,
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
             self.logger.error(f"Erro ao extrair tópicos: {e}")
             return {
                 "result": ["Erro ao extrair tópicos"],
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
@@ -397,7 +750,7 @@ Resposta (formato JSON):
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="sentiment")
             try:
                 sentiment_data = json.loads(response.strip())
                 return sentiment_data
@@ -446,7 +799,7 @@ Resposta (formato JSON):
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="sentiment")
             try:
                 sentiment_data = json.loads(response.strip())
                 result = sentiment_data
@@ -460,7 +813,7 @@ Resposta (formato JSON):
             
             return {
                 "result": result,
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
@@ -472,7 +825,7 @@ Resposta (formato JSON):
                     "emotions": ["erro"],
                     "description": "Erro na análise"
                 },
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
@@ -496,7 +849,7 @@ Insights:
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="insights")
             insights = [line.strip() for line in response.strip().split('\n') if line.strip()]
             return insights[:3]
         except Exception as e:
@@ -537,7 +890,7 @@ Responda APENAS com o JSON:
 """
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="insights")
             response_clean = response.strip()
             
             # Tentar parse JSON direto
@@ -549,8 +902,7 @@ Responda APENAS com o JSON:
                     result = [str(insights)]
             except json.JSONDecodeError:
                 # Tentar extrair JSON da resposta
-                import re
-                json_match = re.search(r'\[.*?\]', response_clean, re.DOTALL)
+                json_match = _JSON_ARRAY_RE.search(response_clean)
                 if json_match:
                     try:
                         insights = json.loads(json_match.group())
@@ -570,14 +922,14 @@ Responda APENAS com o JSON:
             
             return {
                 "result": result,
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
             self.logger.error(f"Erro ao gerar insights: {e}")
             return {
                 "result": ["Erro ao gerar insights"],
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
@@ -607,7 +959,8 @@ Responda APENAS com o JSON:
             'audio_percentage': (audio_messages / total_messages * 100) if total_messages > 0 else 0
         }
     
-    def _call_ollama(self, prompt: str, max_retries: int = 3, system_prompt: str = None) -> str:
+    def _call_ollama(self, prompt: str, max_retries: int = 3, system_prompt: str = None,
+                     response_format: Optional[str] = None, task: Optional[str] = None) -> str:
         """Chamar API do Ollama com estatísticas detalhadas"""
         start_time = time.time()
         
@@ -620,31 +973,41 @@ Responda APENAS com o JSON:
             "model": self.model,
             "prompt": prompt,
             "stream": False,
+            "keep_alive": self.keep_alive,
             "options": {
                 "temperature": 0.4,
                 "top_p": 0.9,
                 "repeat_penalty": 1.15,
-                "num_predict": 1536
+                "num_predict": self.NUM_PREDICT,
+                "num_ctx": self.num_ctx,
+                **self.TASK_OPTIONS.get(task, {})
             }
         }
         
+        response_format = response_format or self.TASK_FORMATS.get(task)
+        
         # Adicionar system prompt se fornecido
         if system_prompt:
             payload["system"] = system_prompt
         
+        # Forçar saída estruturada (ex: "json") quando solicitado
+        if response_format:
+            payload["format"] = response_format
+        
         for attempt in range(max_retries):
             try:
                 self.logger.debug(f"🔄 Chamada Ollama - Tentativa {attempt + 1}")
                 self.logger.debug(f"📊 Input: {total_input_tokens} tokens (prompt: {prompt_tokens}, system: {system_tokens})")
                 
-                response = requests.post(
-                    f"{self.base_url}/api/generate",
-                    json=payload,
-                    timeout=60
-                )
-                response.raise_for_status()
+                with self._ollama_slots:
+                    response = self._http.post(
+                        f"{self.base_url}/api/generate",
+                        json=payload,
+                        timeout=(self.CONNECT_TIMEOUT, 60)
+                    )
+                    response.raise_for_status()
+                    result = response.json()
                 
-                result = response.json()
                 response_text = result.get('response', '').strip()
                 
                 # Calcular estatísticas da resposta
@@ -654,10 +1017,14 @@ Responda APENAS com o JSON:
                 tokens_per_second = output_tokens / duration if duration > 0 else 0
                 
                 # Atualizar estatísticas globais
-                self.usage_stats["total_requests"] += 1
-                self.usage_stats["total_input_tokens"] += total_input_tokens
-                self.usage_stats["total_output_tokens"] += output_tokens
-                self.usage_stats["total_time"] += duration
+                with self._stats_lock:
+                    self.usage_stats["total_requests"] += 1
+                    self.usage_stats["total_input_tokens"] += total_input_tokens
+                    self.usage_stats["total_output_tokens"] += output_tokens
+                    self.usage_stats["total_time"] += duration
+                    total_requests = self.usage_stats["total_requests"]
+                    total_tokens = self.usage_stats["total_input_tokens"] + self.usage_stats["total_output_tokens"]
+                    total_time = self.usage_stats["total_time"]
                 
                 # Log detalhado das estatísticas
                 self.logger.info(f"✅ Ollama Response - {duration:.2f}s")
@@ -666,9 +1033,8 @@ Responda APENAS com o JSON:
                 self.logger.info(f"🎯 Modelo: {self.model}")
                 
                 # Log de estatísticas acumuladas
-                total_tokens = self.usage_stats["total_input_tokens"] + self.usage_stats["total_output_tokens"]
-                avg_speed = total_tokens / self.usage_stats["total_time"] if self.usage_stats["total_time"] > 0 else 0
-                self.logger.info(f"📈 ACUMULADO: {self.usage_stats['total_requests']} requests, {total_tokens} tokens, {avg_speed:.2f} tokens/s médio")
+                avg_speed = total_tokens / total_time if total_time > 0 else 0
+                self.logger.info(f"📈 ACUMULADO: {total_requests} requests, {total_tokens} tokens, {avg_speed:.2f} tokens/s médio")
                 
                 # Log de performance
                 if duration > 30:
@@ -734,7 +1100,8 @@ Responda APENAS com o JSON:
         print(f"🕐 Uptime: {stats['uptime']:.2f}s")
         print("=" * 60)
     
-    def _analyze_contact(self, contact: Dict, diary_data: Dict, contact_idx: int) -> Optional[Dict]:
+    def _analyze_contact(self, contact: Dict, diary_data: Dict, contact_idx: int,
+                         diary_context: DiaryContext) -> Optional[Dict]:
         """Analisar conversa individual de um contato"""
         try:
             contact_name = contact.get('contact_name', 'Desconhecido')
@@ -749,16 +1116,21 @@ Responda APENAS com o JSON:
             if not conversation_text.strip():
                 return None
             
+            conversation_text = self._fit_to_context(conversation_text)
+            
+            # Resumo, tópicos, sentimento e insights em uma única chamada
+            combined = self._analyze_contact_combined(conversation_text, contact_name, diary_context)
+            
             # Análise completa do contato
             analysis = {
                 'contact_name': contact_name,
                 'contact_phone': contact.get('contact_phone', ''),
                 'contact_key': contact.get('contact_key', ''),
                 'contact_idx': contact_idx,
-                'summary': self._generate_contact_summary(conversation_text, contact_name, diary_data),
-                'topics': self._extract_contact_topics(conversation_text, contact_name, diary_data),
-                'sentiment': self._analyze_contact_sentiment(conversation_text, contact_name, diary_data),
-                'insights': self._generate_contact_insights(conversation_text, contact_name, diary_data),
+                'summary': combined['summary'],
+                'topics': combined['topics'],
+                'sentiment': combined['sentiment'],
+                'insights': combined['insights'],
                 'conversation_stats': self._calculate_contact_stats(contact),
                 'success': True,
                 'analyzed_at': datetime.now().isoformat()
@@ -839,103 +1211,91 @@ Responda APENAS com o JSON:
         
         return "\n".join(text_parts)
     
-    def _generate_contact_summary(self, conversation_text: str, contact_name: str, diary_data: Dict) -> Dict:
-        """Gerar resumo da conversa com um contato específico"""
-        user_name = diary_data.get('user_name', 'Usuário')
-        company_name = diary_data.get('company_name', 'Empresa')
-        date_formatted = diary_data.get('date_formatted', 'Data')
+    def _analyze_contact_combined(self, conversation_text: str, contact_name: str, diary_context: DiaryContext) -> Dict[str, Dict]:
+        """Gerar resumo, tópicos, sentimento e insights do contato em uma única chamada ao Ollama
         
-        prompt = f"""
-CONTEXTO DA ANÁLISE:
-Você está analisando uma conversa do WhatsApp Business de um dia de trabalho específico.
-
-DADOS DO USUÁRIO:
-- Nome: {user_name}
-- Empresa: {company_name}
-- Data: {date_formatted}
-- Papel: Funcionário/Atendente da empresa
-
-DADOS DO CONTATO:
-- Nome: {contact_name}
-- Papel: Cliente/Lead/Prospect da empresa
-- Relacionamento: Conversa comercial/profissional
-
-PROPÓSITO DA ANÁLISE:
-Esta análise faz parte de um sistema de inteligência empresarial que:
-1. Avalia a qualidade do atendimento ao cliente
-2. Identifica oportunidades de melhoria no relacionamento
-3. Extrai insights sobre necessidades dos clientes
-4. Monitora padrões de comunicação e vendas
-5. Gera feedback para treinamento e desenvolvimento
-
-CONVERSA A SER ANALISADA:
-{conversation_text}
-
-INSTRUÇÕES ESPECÍFICAS:
-- Analise a conversa do ponto de vista de atendimento ao cliente
-- Identifique o nível de satisfação do cliente {contact_name}
-- Avalie a efetividade da comunicação de {user_name}
-- Destaque oportunidades de venda ou upsell
-- Identifique problemas ou objeções do cliente
-- Avalie se o atendimento foi resolutivo
-- Considere o contexto histórico para entender a evolução do relacionamento
-- Use transcrições de áudio e análises de imagem como conteúdo real
-- Seja objetivo e focado em insights acionáveis
-
-Resumo da conversa com {contact_name}:
-"""
+        A conversa é enviada (e processada pelo modelo) uma única vez. Campos ausentes ou
+        inválidos na resposta são refeitos com o prompt individual correspondente.
+        """
+        prompt = self._PROMPT_CONTACT_COMBINED.substitute(
+            user_name=diary_context.user_name,
+            company_name=diary_context.company_name,
+            date_formatted=diary_context.date_formatted,
+            contact_name=contact_name,
+            conversation_text=conversation_text
+        )
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, response_format="json")
+            data = json.loads(response.strip())
+            if not isinstance(data, dict):
+                data = {}
+        except Exception as e:
+            self.logger.warning(f"⚠️ Análise combinada do contato falhou, usando prompts individuais: {e}")
+            data = {}
+        
+        if isinstance(data.get('summary'), str):
+            data['summary'] = data['summary'].strip()
+        
+        # Campo -> (tipo esperado, prompt individual usado como fallback)
+        fields = {
+            'summary': (str, self._generate_contact_summary),
+            'topics': (list, self._extract_contact_topics),
+            'sentiment': (dict, self._analyze_contact_sentiment),
+            'insights': (list, self._generate_contact_insights)
+        }
+        
+        results = {}
+        for field, (expected_type, fallback) in fields.items():
+            value = data.get(field)
+            if isinstance(value, expected_type) and value:
+                results[field] = {
+                    "result": value,
+                    **self._prompt_fields(prompt),
+                    "success": True
+                }
+            else:
+                results[field] = fallback(conversation_text, contact_name, diary_context)
+        
+        return results
+    
+    def _generate_contact_summary(self, conversation_text: str, contact_name: str, diary_context: DiaryContext) -> Dict:
+        """Gerar resumo da conversa com um contato específico"""
+        prompt = self._PROMPT_CONTACT_SUMMARY.substitute(
+            user_name=diary_context.user_name,
+            company_name=diary_context.company_name,
+            date_formatted=diary_context.date_formatted,
+            contact_name=contact_name,
+            conversation_text=conversation_text
+        )
+        
+        try:
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="summary")
             return {
                 "result": response.strip(),
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
             self.logger.error(f"Erro ao gerar resumo do contato: {e}")
             return {
                 "result": f"Erro ao gerar resumo da conversa com {contact_name}",
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
     
-    def _extract_contact_topics(self, conversation_text: str, contact_name: str, diary_data: Dict) -> Dict:
+    def _extract_contact_topics(self, conversation_text: str, contact_name: str, diary_context: DiaryContext) -> Dict:
         """Extrair tópicos da conversa com um contato específico"""
-        user_name = diary_data.get('user_name', 'Usuário')
-        company_name = diary_data.get('company_name', 'Empresa')
-        
-        prompt = f"""
-CONTEXTO:
-Você está analisando uma conversa comercial do WhatsApp Business entre:
-- {user_name} (funcionário da {company_name})
-- {contact_name} (cliente/lead)
-
-PROPÓSITO:
-Identificar os principais tópicos de negócio discutidos para categorização e análise de vendas.
-
-CONVERSA:
-{conversation_text}
-
-INSTRUÇÕES:
-- Identifique 3-5 tópicos principais relacionados a NEGÓCIOS/VENDAS/ATENDIMENTO
-- Foque em: produtos, serviços, preços, dúvidas, objeções, necessidades, problemas
-- Use palavras-chave comerciais (máximo 3 palavras por tópico)
-- Responda APENAS com JSON válido
-- NÃO inclua texto explicativo
-
-EXEMPLOS DE TÓPICOS COMERCIAIS:
-["produto", "preço", "desconto"]
-["dúvida", "especificação", "prazo"]
-["objeção", "concorrência", "custo"]
-["necessidade", "solução", "benefício"]
-
-Responda APENAS com o JSON:
-"""
+        prompt = self._PROMPT_CONTACT_TOPICS.substitute(
+            user_name=diary_context.user_name,
+            company_name=diary_context.company_name,
+            contact_name=contact_name,
+            conversation_text=conversation_text
+        )
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="topics")
             response_clean = response.strip()
             
             # Tentar parse JSON direto
@@ -947,8 +1307,7 @@ Responda APENAS com o JSON:
                     result = [str(topics)]
             except json.JSONDecodeError:
                 # Tentar extrair JSON da resposta
-                import re
-                json_match = re.search(r'\[.*?\]', response_clean, re.DOTALL)
+                json_match = _JSON_ARRAY_RE.search(response_clean)
                 if json_match:
                     try:
                         topics = json.loads(json_match.group())
@@ -964,56 +1323,29 @@ Responda APENAS com o JSON:
             
             return {
                 "result": result,
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
             self.logger.error(f"Erro ao extrair tópicos do contato: {e}")
             return {
                 "result": ["Erro ao extrair tópicos"],
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
     
-    def _analyze_contact_sentiment(self, conversation_text: str, contact_name: str, diary_data: Dict) -> Dict:
+    def _analyze_contact_sentiment(self, conversation_text: str, contact_name: str, diary_context: DiaryContext) -> Dict:
         """Analisar sentimento da conversa com um contato específico"""
-        user_name = diary_data.get('user_name', 'Usuário')
-        company_name = diary_data.get('company_name', 'Empresa')
-        
-        prompt = f"""
-CONTEXTO COMERCIAL:
-Você está analisando o sentimento de uma conversa de vendas/atendimento entre:
-- {user_name} (funcionário da {company_name})
-- {contact_name} (cliente/lead)
-
-PROPÓSITO:
-Avaliar a satisfação do cliente e a efetividade do atendimento para melhorar o relacionamento comercial.
-
-CONVERSA:
-{conversation_text}
-
-INSTRUÇÕES:
-- Analise o sentimento do CLIENTE ({contact_name}) em relação ao atendimento
-- Avalie a efetividade da comunicação do FUNCIONÁRIO ({user_name})
-- Identifique sinais de satisfação, insatisfação, interesse ou desinteresse
-- Considere o contexto histórico para entender a evolução do relacionamento
-- Use transcrições de áudio e análises de imagem como conteúdo real
-- Foque em aspectos comerciais: interesse em comprar, confiança, objeções
-
-Responda em formato JSON:
-{{
-  "overall_sentiment": "positivo/negativo/neutro",
-  "confidence": 0.0-1.0,
-  "emotions": ["interesse", "satisfação", "dúvida", "frustração", etc],
-  "description": "Breve análise do sentimento comercial"
-}}
-
-Resposta (formato JSON):
-"""
+        prompt = self._PROMPT_CONTACT_SENTIMENT.substitute(
+            user_name=diary_context.user_name,
+            company_name=diary_context.company_name,
+            contact_name=contact_name,
+            conversation_text=conversation_text
+        )
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="sentiment")
             try:
                 sentiment_data = json.loads(response.strip())
                 result = sentiment_data
@@ -1027,7 +1359,7 @@ Resposta (formato JSON):
             
             return {
                 "result": result,
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
@@ -1039,46 +1371,22 @@ Resposta (formato JSON):
                     "emotions": ["erro"],
                     "description": "Erro na análise"
                 },
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
     
-    def _generate_contact_insights(self, conversation_text: str, contact_name: str, diary_data: Dict) -> Dict:
+    def _generate_contact_insights(self, conversation_text: str, contact_name: str, diary_context: DiaryContext) -> Dict:
         """Gerar insights sobre a conversa com um contato específico"""
-        user_name = diary_data.get('user_name', 'Usuário')
-        company_name = diary_data.get('company_name', 'Empresa')
-        
-        prompt = f"""
-CONTEXTO COMERCIAL:
-Você está analisando uma conversa de vendas/atendimento entre:
-- {user_name} (funcionário da {company_name})
-- {contact_name} (cliente/lead)
-
-PROPÓSITO:
-Gerar insights acionáveis para melhorar vendas, atendimento e relacionamento com o cliente.
-
-CONVERSA:
-{conversation_text}
-
-INSTRUÇÕES:
-- Gere 3 insights COMERCIAIS específicos sobre {contact_name}
-- Foque em: perfil do cliente, necessidades, objeções, oportunidades de venda
-- Identifique padrões de comportamento e preferências
-- Destaque sinais de interesse ou desinteresse
-- Compare com histórico para identificar evolução
-- Cada insight deve ser acionável para vendas/atendimento
-- Responda APENAS com JSON válido
-
-EXEMPLOS DE INSIGHTS COMERCIAIS:
-["Cliente demonstra alto interesse em produtos premium", "Sensibilidade a preços sugere foco em soluções econômicas", "Comunicação formal indica perfil B2B corporativo"]
-["Lead apresenta objeções sobre prazo de entrega", "Necessidade específica de customização identificada", "Sinal de interesse em proposta comercial"]
-
-Responda APENAS com o JSON:
-"""
+        prompt = self._PROMPT_CONTACT_INSIGHTS.substitute(
+            user_name=diary_context.user_name,
+            company_name=diary_context.company_name,
+            contact_name=contact_name,
+            conversation_text=conversation_text
+        )
         
         try:
-            response = self._call_ollama(prompt, system_prompt=self.system_prompt)
+            response = self._call_ollama(prompt, system_prompt=self.system_prompt, task="insights")
             response_clean = response.strip()
             
             # Tentar parse JSON direto
@@ -1090,8 +1398,7 @@ Responda APENAS com o JSON:
                     result = [str(insights)]
             except json.JSONDecodeError:
                 # Tentar extrair JSON da resposta
-                import re
-                json_match = re.search(r'\[.*?\]', response_clean, re.DOTALL)
+                json_match = _JSON_ARRAY_RE.search(response_clean)
                 if json_match:
                     try:
                         insights = json.loads(json_match.group())
@@ -1111,14 +1418,14 @@ Responda APENAS com o JSON:
             
             return {
                 "result": result,
-                "prompt": prompt,
+                **self._prompt_fields(prompt),
                 "success": True
             }
         except Exception as e:
             self.logger.error(f"Erro ao gerar insights do contato: {e}")
             return {
                 "result": ["Erro ao gerar insights"],
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
@@ -1127,27 +1434,18 @@ Responda APENAS com o JSON:
         """Calcular estatísticas da conversa com um contato"""
         messages = contact.get('messages', [])
         total_messages = len(messages)
-        audio_messages = 0
-        text_messages = 0
-        image_messages = 0
-        sent_messages = 0
-        received_messages = 0
         
-        for message in messages:
-            message_type = message.get('message_type', 'text')
-            from_me = message.get('from_me', False)
-            
-            if from_me:
-                sent_messages += 1
-            else:
-                received_messages += 1
-            
-            if message_type == 'audio':
-                audio_messages += 1
-            elif message_type == 'image':
-                image_messages += 1
-            else:
-                text_messages += 1
+        # Contagem única por (tipo, enviada) - demais campos derivados dela
+        counts = Counter(
+            (message.get('message_type', 'text'), bool(message.get('from_me', False)))
+            for message in messages
+        )
+        
+        sent_messages = sum(count for (_, from_me), count in counts.items() if from_me)
+        received_messages = total_messages - sent_messages
+        audio_messages = counts[('audio', True)] + counts[('audio', False)]
+        image_messages = counts[('image', True)] + counts[('image', False)]
+        text_messages = total_messages - audio_messages - image_messages
         
         return {
             'total_messages': total_messages,
@@ -1161,10 +1459,12 @@ Responda APENAS com o JSON:
             'image_percentage': (image_messages / total_messages * 100) if total_messages > 0 else 0
         }
     
-    def _generate_diary_summary(self, contact_analyses: List[Dict], diary_data: Dict) -> Dict:
+    def _generate_diary_summary(self, contact_analyses: List[Dict], diary_data: Dict,
+                                successful_analyses: Optional[List[Dict]] = None) -> Dict:
         """Gerar resumo global do diário baseado nas análises dos contatos"""
         # Preparar dados consolidados
-        successful_analyses = [ca for ca in contact_analyses if ca.get('success', False)]
+        if successful_analyses is None:
+            successful_analyses = [ca for ca in contact_analyses if ca.get('success', False)]
         
         if not successful_analyses:
             return {
@@ -1172,55 +1472,53 @@ Responda APENAS com o JSON:
                 "success": False
             }
         
-        # Consolidar informações
-        all_topics = []
-        all_sentiments = []
-        all_insights = []
-        contact_summaries = []
-        
+        # Consolidar informações (tópicos e insights já deduplicados)
+        all_topics = set()
+        all_insights = set()
         for analysis in successful_analyses:
-            contact_name = analysis.get('contact_name', 'Desconhecido')
-            
-            # Tópicos
             topics = analysis.get('topics', {}).get('result', [])
             if isinstance(topics, list):
-                # Garantir que cada item é uma string, não uma lista
-                for topic in topics:
-                    if isinstance(topic, str):
-                        all_topics.append(topic)
-                    elif isinstance(topic, list):
-                        all_topics.extend([str(t) for t in topic if isinstance(t, str)])
-            
-            # Sentimentos
-            sentiment = analysis.get('sentiment', {}).get('result', {})
-            if isinstance(sentiment, dict):
-                all_sentiments.append(sentiment)
+                all_topics.update(_flatten_strings(topics))
             
-            # Insights
             insights = analysis.get('insights', {}).get('result', [])
             if isinstance(insights, list):
-                # Garantir que cada item é uma string, não uma lista
-                for insight in insights:
-                    if isinstance(insight, str):
-                        all_insights.append(insight)
-                    elif isinstance(insight, list):
-                        all_insights.extend([str(i) for i in insight if isinstance(i, str)])
-            
-            # Resumos
-            summary = analysis.get('summary', {}).get('result', '')
-            if summary:
-                contact_summaries.append(f"{contact_name}: {summary}")
+                all_insights.update(_flatten_strings(insights))
+        
+        all_sentiments = [
+            sentiment for analysis in successful_analyses
+            if isinstance(sentiment := analysis.get('sentiment', {}).get('result', {}), dict)
+        ]
+        
+        contact_summaries = [
+            f"{analysis.get('contact_name', 'Desconhecido')}: {summary}"
+            for analysis in successful_analyses
+            if (summary := analysis.get('summary', {}).get('result', ''))
+        ]
+        
+        # Ordenar uma única vez: prompt estável entre execuções (cache) e reuso no resultado
+        unique_topics = sorted(all_topics)
+        unique_insights = sorted(all_insights)
+        
+        consolidated_data = {
+            "total_contacts": len(contact_analyses),
+            "successful_analyses": len(successful_analyses),
+            "unique_topics": unique_topics,
+            "sentiment_summary": self._calculate_sentiment_summary(all_sentiments),
+            "raw_insights": unique_insights[:5]
+        }
         
         # Gerar prompt para resumo global
+        topics_text = ', '.join(unique_topics)
+        insights_text = '\n'.join(unique_insights)
         consolidated_text = f"""
 RESUMOS DAS CONVERSAS:
 {chr(10).join(contact_summaries)}
 
-TÓPICOS IDENTIFICADOS: {', '.join(set(all_topics))}
+TÓPICOS IDENTIFICADOS: {topics_text}
 
 SENTIMENTOS: {len(all_sentiments)} conversas analisadas
 
-INSIGHTS: {chr(10).join(set(all_insights))}
+INSIGHTS: {insights_text}
 """
         
         prompt = f"""
@@ -1304,15 +1602,9 @@ Responda APENAS com o JSON válido:
                         "feedback": structured_data.get('feedback', {}),
                         "commercial_metrics": structured_data.get('commercial_metrics', {}),
                         "next_actions": structured_data.get('next_actions', []),
-                        "prompt": prompt,
+                        **self._prompt_fields(prompt),
                         "success": True,
-                        "consolidated_data": {
-                            "total_contacts": len(contact_analyses),
-                            "successful_analyses": len(successful_analyses),
-                            "unique_topics": list(set(all_topics)),
-                            "sentiment_summary": self._calculate_sentiment_summary(all_sentiments),
-                            "raw_insights": list(set(all_insights))[:5]
-                        }
+                        "consolidated_data": consolidated_data
                     }
                 else:
                     # Fallback se JSON estiver incompleto
@@ -1323,15 +1615,9 @@ Responda APENAS com o JSON válido:
                         "feedback": {},
                         "commercial_metrics": {},
                         "next_actions": [],
-                        "prompt": prompt,
+                        **self._prompt_fields(prompt),
                         "success": True,
-                        "consolidated_data": {
-                            "total_contacts": len(contact_analyses),
-                            "successful_analyses": len(successful_analyses),
-                            "unique_topics": list(set(all_topics)),
-                            "sentiment_summary": self._calculate_sentiment_summary(all_sentiments),
-                            "raw_insights": list(set(all_insights))[:5]
-                        }
+                        "consolidated_data": consolidated_data
                     }
             except json.JSONDecodeError:
                 # Fallback se não conseguir fazer parse do JSON
@@ -1342,15 +1628,9 @@ Responda APENAS com o JSON válido:
                     "feedback": {},
                     "commercial_metrics": {},
                     "next_actions": [],
-                    "prompt": prompt,
+                    **self._prompt_fields(prompt),
                     "success": True,
-                    "consolidated_data": {
-                        "total_contacts": len(contact_analyses),
-                        "successful_analyses": len(successful_analyses),
-                        "unique_topics": list(set(all_topics)),
-                        "sentiment_summary": self._calculate_sentiment_summary(all_sentiments),
-                        "raw_insights": list(set(all_insights))[:5]
-                    }
+                    "consolidated_data": consolidated_data
                 }
         except Exception as e:
             self.logger.error(f"Erro ao gerar resumo global: {e}")
@@ -1361,7 +1641,7 @@ Responda APENAS com o JSON válido:
                 "feedback": {},
                 "commercial_metrics": {},
                 "next_actions": [],
-                "prompt": prompt,
+                **self._prompt_fields(prompt, error=True),
                 "success": False,
                 "error": str(e)
             }
@@ -1371,9 +1651,16 @@ Responda APENAS com o JSON válido:
         if not sentiments:
             return {"overall": "neutro", "confidence": 0.0}
         
-        positive_count = sum(1 for s in sentiments if s.get('overall_sentiment') == 'positivo')
-        negative_count = sum(1 for s in sentiments if s.get('overall_sentiment') == 'negativo')
-        neutral_count = sum(1 for s in sentiments if s.get('overall_sentiment') == 'neutro')
+        # Passada única sobre os sentimentos (rótulos + soma de confiança)
+        counts = Counter()
+        confidence_sum = 0
+        for s in sentiments:
+            counts[s.get('overall_sentiment')] += 1
+            confidence_sum += s.get('confidence', 0)
+        
+        positive_count = counts['positivo']
+        negative_count = counts['negativo']
+        neutral_count = counts['neutro']
         
         total = len(sentiments)
         
@@ -1384,7 +1671,7 @@ Responda APENAS com o JSON válido:
         else:
             overall = "neutro"
         
-        avg_confidence = sum(s.get('confidence', 0) for s in sentiments) / total
+        avg_confidence = confidence_sum / total
         
         return {
             "overall": overall,
@@ -1395,14 +1682,20 @@ Responda APENAS com o JSON válido:
             "total_conversations": total
         }
     
-    def _calculate_analysis_stats(self, contact_analyses: List[Dict], diary_data: Dict) -> Dict[str, Any]:
+    def _calculate_analysis_stats(self, contact_analyses: List[Dict], diary_data: Dict,
+                                  successful_analyses: Optional[List[Dict]] = None) -> Dict[str, Any]:
         """Calcular estatísticas gerais da análise"""
-        successful_analyses = [ca for ca in contact_analyses if ca.get('success', False)]
+        if successful_analyses is None:
+            successful_analyses = [ca for ca in contact_analyses if ca.get('success', False)]
         
-        total_messages = sum(ca.get('conversation_stats', {}).get('total_messages', 0) for ca in successful_analyses)
-        total_audio = sum(ca.get('conversation_stats', {}).get('audio_messages', 0) for ca in successful_analyses)
-        total_text = sum(ca.get('conversation_stats', {}).get('text_messages', 0) for ca in successful_analyses)
-        total_images = sum(ca.get('conversation_stats', {}).get('image_messages', 0) for ca in successful_analyses)
+        # Passada única acumulando os quatro totais
+        total_messages = total_audio = total_text = total_images = 0
+        for ca in successful_analyses:
+            stats = ca.get('conversation_stats') or {}
+            total_messages += stats.get('total_messages', 0)
+            total_audio += stats.get('audio_messages', 0)
+            total_text += stats.get('text_messages', 0)
+            total_images += stats.get('image_messages', 0)
         
         return {
             'total_contacts': len(contact_analyses),
@@ -1424,7 +1717,7 @@ Responda APENAS com o JSON válido:
         self.logger.info("Testando conexao com Ollama...")
         
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=10)
+            response = self._http.get(f"{self.base_url}/api/tags", timeout=(self.CONNECT_TIMEOUT, 10))
             response.raise_for_status()
             
             models = response.json().get('models', [])
@@ -1463,18 +1756,20 @@ Responda APENAS com o JSON válido:
                 "model": self.model,
                 "prompt": text,
                 "stream": False,
+                "keep_alive": self.keep_alive,
                 "options": {
                     "temperature": 0.4,
                     "top_p": 0.9,
                     "repeat_penalty": 1.15,
-                    "num_predict": 1536
+                    "num_predict": self.NUM_PREDICT,
+                    "num_ctx": self.num_ctx
                 }
             }
             
-            response = requests.post(
+            response = self._http.post(
                 f"{self.base_url}/api/generate",
                 json=payload,
-                timeout=30
+                timeout=(self.CONNECT_TIMEOUT, 30)
             )
             response.raise_for_status()
             
@@ -1558,3 +1853,8 @@ Responda APENAS com o JSON válido:
         
         self.logger.info("Teste completo finalizado")
         return results
+    
+    def _cleanup(self):
+        """Fechar sessão HTTP"""
+        if hasattr(self, '_http'):
+            self._http.close()
@@ -2,10 +2,13 @@
 Service para processamento de áudio com Whisper
 """
 import torch
-import whisper
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
 import tempfile
 import shutil
-import json
+import orjson
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple, Any
 import time
@@ -17,16 +20,52 @@ from ..config import Config
 class AudioService(BaseService):
     """Service para processamento de áudio"""
     
+    # Silero VAD do faster-whisper: apenas trechos de fala (+200ms de contexto) vão ao Whisper
+    VAD_PARAMETERS = {"speech_pad_ms": 200}
+    
+    # Decodificação gulosa sem condicionamento no texto anterior (uma passada por janela)
+    DECODE_OPTIONS = {
+        "beam_size": 1,
+        "best_of": 1,
+        "temperature": 0.0,
+        "condition_on_previous_text": False,
+        "compression_ratio_threshold": 2.4,
+        "log_prob_threshold": -1.0,
+        "no_speech_threshold": 0.6
+    }
+    
+    # Modo alta qualidade: beam search e fallback de temperatura. Só funciona na
+    # transcrição sequencial (WhisperModel.transcribe): o pipeline em lote usa apenas
+    # a primeira temperatura, ignora best_of e nunca redecodifica pelos limiares
+    DECODE_OPTIONS_HIGH_QUALITY = {
+        **DECODE_OPTIONS,
+        "beam_size": 5,
+        "best_of": 5,
+        "temperature": (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+    }
+    
     def _initialize(self):
         """Inicializar modelo Whisper"""
+        # Consultas ao driver CUDA feitas uma única vez
+        self._cuda_available = torch.cuda.is_available()
+        self._device_props = torch.cuda.get_device_properties(torch.cuda.current_device()) if self._cuda_available else None
         self.device = self._setup_gpu()
         self.model = None
+        self._pipelines = threading.local()
+        self._db_service = None
+        self._created_dirs = set()
         self._load_whisper_model()
+        
+        # Um worker por GPU: transcrições de um batch distribuídas entre as réplicas do modelo
+        self._transcribe_executor = ThreadPoolExecutor(
+            max_workers=self._gpu_count,
+            thread_name_prefix="whisper"
+        )
     
     def _setup_gpu(self) -> str:
         """Configurar GPU para processamento com fallback automático"""
         try:
-            if torch.cuda.is_available():
+            if self._cuda_available:
                 device = f"cuda:{torch.cuda.current_device()}"
                 
                 # Configurar memória apenas se disponível
@@ -35,8 +74,8 @@ class AudioService(BaseService):
                 except Exception as e:
                     self.logger.warning(f"⚠️ Não foi possível configurar memória GPU: {e}")
                 
-                gpu_name = torch.cuda.get_device_name()
-                total_memory = torch.cuda.get_device_properties(0).total_memory / (1024**3)
+                gpu_name = self._device_props.name
+                total_memory = self._device_props.total_memory / (1024**3)
                 
                 self.logger.info(f"🚀 GPU detectada: {gpu_name} ({total_memory:.1f}GB)")
                 self.logger.info(f"🔧 Memória configurada: {Config.GPU_MEMORY_FRACTION*100}%")
@@ -50,48 +89,100 @@ class AudioService(BaseService):
             return "cpu"
     
     def _load_whisper_model(self):
-        """Carregar modelo Whisper"""
+        """Carregar modelo Whisper (faster-whisper / CTranslate2)"""
         try:
             self.logger.info(f"📥 Carregando modelo Whisper: {Config.WHISPER_MODEL}")
-            self.model = whisper.load_model(
+            device_type, _, device_index = self.device.partition(':')
+            compute_type = self._resolve_compute_type(device_type)
+            
+            # Várias GPUs: CTranslate2 carrega uma réplica por dispositivo e atende threads em paralelo
+            self._gpu_count = torch.cuda.device_count() if self._cuda_available else 1
+            if self._gpu_count > 1:
+                device_index = list(range(self._gpu_count))
+                self.logger.info(f"🖥️ Carregando réplicas do modelo em {self._gpu_count} GPUs")
+            else:
+                device_index = int(device_index) if device_index else 0
+            
+            self.model = WhisperModel(
                 Config.WHISPER_MODEL,
-                device=self.device,
+                device=device_type,
+                device_index=device_index,
+                compute_type=compute_type,
                 download_root=str(Config.MODELS_DIR)
             )
-            self.logger.info("✅ Modelo Whisper carregado")
+            self.logger.info(f"✅ Modelo Whisper carregado ({compute_type})")
         except Exception as e:
             self.logger.error(f"❌ Erro ao carregar modelo: {e}")
             raise
     
-    def transcribe_file(self, file_path: str) -> Optional[Dict]:
-        """Transcrever arquivo individual"""
+    def _batched_pipeline(self) -> BatchedInferencePipeline:
+        """Pipeline em lote da thread atual
+        
+        Trechos de fala (VAD) de até 30s processados juntos no encoder. O pipeline
+        guarda estado por chamada (last_speech_timestamp, usado com word_timestamps),
+        então cada worker tem o seu; o modelo (pesos) continua compartilhado.
+        """
+        pipeline = getattr(self._pipelines, "batched", None)
+        if pipeline is None:
+            pipeline = BatchedInferencePipeline(model=self.model)
+            self._pipelines.batched = pipeline
+        return pipeline
+    
+    def _resolve_compute_type(self, device_type: str) -> str:
+        """Definir precisão dos pesos: FP16 na GPU, INT8 na CPU (ou valor do Config)"""
+        if Config.WHISPER_COMPUTE_TYPE != "auto":
+            return Config.WHISPER_COMPUTE_TYPE
+        return "float16" if device_type == "cuda" else "int8"
+    
+    def transcribe_file(self, file_path: str, audio: Optional[Any] = None,
+                        word_timestamps: Optional[bool] = None,
+                        high_quality: Optional[bool] = None) -> Optional[Dict]:
+        """Transcrever arquivo individual (opcionalmente com áudio já decodificado a 16kHz)"""
         self._ensure_initialized()
         self._log_operation("transcrição de arquivo", {"file_path": file_path})
         
         try:
-            if not Path(file_path).exists():
+            if audio is None and not Path(file_path).exists():
                 self.logger.error(f"Arquivo não encontrado: {file_path}")
                 return None
             
-            # Carregar áudio
-            audio = whisper.load_audio(file_path)
-            audio = whisper.pad_or_trim(audio)
+            if word_timestamps is None:
+                word_timestamps = Config.WHISPER_WORD_TIMESTAMPS
+            if high_quality is None:
+                high_quality = Config.WHISPER_HIGH_QUALITY
+            
+            # Transcrever (decodificação do áudio e VAD feitos pelo faster-whisper)
+            transcribe_options = {
+                "language": Config.WHISPER_LANGUAGE,
+                "word_timestamps": word_timestamps,
+                "vad_filter": True,
+                "vad_parameters": self.VAD_PARAMETERS
+            }
+            if high_quality:
+                # Sequencial: único caminho que aplica o fallback de temperatura
+                segments_iter, info = self.model.transcribe(
+                    file_path if audio is None else audio,
+                    **transcribe_options,
+                    **self.DECODE_OPTIONS_HIGH_QUALITY
+                )
+            else:
+                segments_iter, info = self._batched_pipeline().transcribe(
+                    file_path if audio is None else audio,
+                    **transcribe_options,
+                    batch_size=Config.GPU_BATCH_SIZE,
+                    **self.DECODE_OPTIONS
+                )
             
-            # Transcrever
-            result = self.model.transcribe(
-                audio,
-                language=Config.WHISPER_LANGUAGE,
-                word_timestamps=True,
-                fp16=torch.cuda.is_available()
-            )
+            # Segmentos são gerados sob demanda - materializar uma única vez
+            segments = [self._segment_to_dict(segment) for segment in segments_iter]
             
             transcription = {
-                'text': result['text'].strip(),
-                'segments': result.get('segments', []),
-                'language': result.get('language', Config.WHISPER_LANGUAGE),
+                'text': ''.join(segment['text'] for segment in segments).strip(),
+                'segments': segments,
+                'language': info.language or Config.WHISPER_LANGUAGE,
                 'file_path': file_path,
-                'duration': len(audio) / 16000,
-                'confidence': self._calculate_confidence(result.get('segments', [])),
+                'duration': info.duration,
+                'confidence': self._calculate_confidence(segments),
                 'transcribed_at': datetime.now().isoformat()
             }
             
@@ -128,43 +219,85 @@ class AudioService(BaseService):
         return results
     
     def _transcribe_batch_gpu(self, audio_files: List[str]) -> List[Optional[Dict]]:
-        """Transcrever batch na GPU"""
+        """Transcrever batch na GPU via pipeline em lote compartilhado"""
+        self._ensure_initialized()
         results = []
         
-        for file_path in audio_files:
-            try:
-                result = self.transcribe_file(file_path)
-                results.append(result)
-            except Exception as e:
-                self.logger.error(f"Erro na transcrição de {file_path}: {e}")
-                results.append(None)
+        # Decodificar todo o batch em paralelo (ffmpeg libera o GIL) enquanto a GPU transcreve
+        with ThreadPoolExecutor(max_workers=max(1, len(audio_files))) as executor:
+            decoded_audios = executor.map(self._decode_audio, audio_files)
+            
+            # Transcrições distribuídas entre as GPUs; ordem preservada pela lista de futures
+            futures = [
+                self._transcribe_executor.submit(self._transcribe_decoded, file_path, audio)
+                for file_path, audio in zip(audio_files, decoded_audios)
+            ]
+        
+        for future in futures:
+            results.append(future.result())
         
         return results
     
+    def _transcribe_decoded(self, file_path: str, audio: Optional[Any]) -> Optional[Dict]:
+        """Transcrever áudio já decodificado (executado no pool de transcrição)"""
+        if audio is None:
+            return None
+        try:
+            return self.transcribe_file(file_path, audio=audio)
+        except Exception as e:
+            self.logger.error(f"Erro na transcrição de {file_path}: {e}")
+            return None
+    
+    def _decode_audio(self, file_path: str) -> Optional[Any]:
+        """Decodificar áudio para waveform mono 16kHz"""
+        try:
+            return decode_audio(file_path, sampling_rate=16000)
+        except Exception as e:
+            self.logger.error(f"Erro ao decodificar {file_path}: {e}")
+            return None
+    
+    def _segment_to_dict(self, segment) -> Dict:
+        """Converter segmento do faster-whisper para o formato de dict do Whisper"""
+        return {
+            'id': segment.id,
+            'start': segment.start,
+            'end': segment.end,
+            'text': segment.text,
+            'avg_logprob': segment.avg_logprob,
+            'compression_ratio': segment.compression_ratio,
+            'no_speech_prob': segment.no_speech_prob,
+            'temperature': segment.temperature,
+            'words': [
+                {'word': word.word, 'start': word.start, 'end': word.end, 'probability': word.probability}
+                for word in (segment.words or [])
+            ]
+        }
+    
     def _calculate_confidence(self, segments: List[Dict]) -> float:
         """Calcular confiança média da transcrição"""
-        if not segments:
-            return 0.0
-        
-        confidences = []
+        total = 0.0
+        count = 0
         for segment in segments:
-            if 'avg_logprob' in segment:
-                # Converter log probability para confiança (0-1)
-                confidence = min(1.0, max(0.0, (segment['avg_logprob'] + 1.0)))
-                confidences.append(confidence)
+            avg_logprob = segment.get('avg_logprob')
+            if avg_logprob is None:
+                continue
+            # Converter log probability para confiança (0-1)
+            confidence = avg_logprob + 1.0
+            total += 0.0 if confidence < 0.0 else (1.0 if confidence > 1.0 else confidence)
+            count += 1
         
-        return sum(confidences) / len(confidences) if confidences else 0.0
+        return total / count if count else 0.0
     
     def get_gpu_info(self) -> Dict[str, Any]:
         """Obter informações da GPU com fallback para CPU"""
         self._ensure_initialized()
         
         try:
-            if torch.cuda.is_available():
+            if self._cuda_available:
                 return {
                     'available': True,
-                    'device_name': torch.cuda.get_device_name(),
-                    'total_memory': torch.cuda.get_device_properties(0).total_memory,
+                    'device_name': self._device_props.name,
+                    'total_memory': self._device_props.total_memory,
                     'allocated_memory': torch.cuda.memory_allocated(),
                     'cached_memory': torch.cuda.memory_reserved(),
                     'memory_fraction': Config.GPU_MEMORY_FRACTION,
@@ -208,17 +341,14 @@ class AudioService(BaseService):
         self._ensure_initialized()
         
         try:
-            # Criar diretório da conversa
-            conv_dir = Config.TRANSCRIPTIONS_DIR / conversation_id
-            conv_dir.mkdir(exist_ok=True)
+            # Criar diretório da conversa (uma vez por conversa)
+            conv_dir = os.path.join(Config.TRANSCRIPTIONS_DIR, conversation_id)
+            if conversation_id not in self._created_dirs:
+                os.makedirs(conv_dir, exist_ok=True)
+                self._created_dirs.add(conversation_id)
             
             # Caminho do arquivo JSON
-            json_path = conv_dir / f"{message_id}.json"
-            
-            # Se já existe, retornar
-            if json_path.exists():
-                self.logger.info(f"Transcrição já existe: {json_path.name}")
-                return str(json_path)
+            json_path = os.path.join(conv_dir, f"{message_id}.json")
             
             # Preparar dados para salvar
             save_data = {
@@ -230,12 +360,19 @@ class AudioService(BaseService):
                 "device": self.device
             }
             
-            # Salvar JSON
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(save_data, f, ensure_ascii=False, indent=2)
+            # Serializar antes de abrir: erro de serialização não deixa arquivo vazio
+            data = orjson.dumps(save_data, option=orjson.OPT_INDENT_2)
+            
+            # Salvar JSON ('xb' falha se já existir - verificação e criação em uma syscall)
+            try:
+                with open(json_path, 'xb') as f:
+                    f.write(data)
+            except FileExistsError:
+                self.logger.info(f"Transcrição já existe: {message_id}.json")
+                return json_path
             
-            self.logger.info(f"✅ Transcrição salva: {json_path.name}")
-            return str(json_path)
+            self.logger.info(f"✅ Transcrição salva: {message_id}.json")
+            return json_path
             
         except Exception as e:
             self.logger.error(f"❌ Erro ao salvar transcrição: {e}")
@@ -247,44 +384,68 @@ class AudioService(BaseService):
         
         try:
             json_path = Config.TRANSCRIPTIONS_DIR / conversation_id / f"{message_id}.json"
-            
-            if not json_path.exists():
-                return None
-            
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
+            data = orjson.loads(json_path.read_bytes())
             return data.get('transcription')
             
+        except FileNotFoundError:
+            return None
         except Exception as e:
             self.logger.error(f"❌ Erro ao carregar transcrição: {e}")
             return None
     
+    def set_db_service(self, db_service):
+        """Definir DatabaseService compartilhado (evita nova conexão por mensagem)"""
+        self._db_service = db_service
+    
+    def _get_db_service(self):
+        """Obter DatabaseService compartilhado, criando sob demanda"""
+        if getattr(self, '_db_service', None) is None:
+            from .database_service import DatabaseService
+            self._db_service = DatabaseService()
+        return self._db_service
+    
+    def _build_collection_data(self, conversation_id: str, message_id: str,
+                               contact_name: str, transcription_data: Dict) -> Dict:
+        """Preparar dados da transcrição para a collection"""
+        return {
+            "mensagem_id": message_id,
+            "user_id": conversation_id,  # Usando conversation_id como user_id por enquanto
+            "company_id": "default",     # Pode ser configurado depois
+            "server_name": "whatsapp",   # Pode ser configurado depois
+            "conversation_id": conversation_id,
+            "contact_name": contact_name,
+            "transcription": transcription_data,
+            "audio_duration": transcription_data.get("duration"),
+            "confidence": transcription_data.get("confidence"),
+            "whisper_model": Config.WHISPER_MODEL,
+            "device": self.device
+        }
+    
+    def save_transcriptions_to_collection(self, pending: List[Dict], db_service=None) -> int:
+        """Salvar em lote as transcrições acumuladas por process_audio_message"""
+        self._ensure_initialized()
+        
+        if not pending:
+            return 0
+        
+        db_service = db_service or self._get_db_service()
+        saved = db_service.save_transcriptions_to_collection(pending)
+        self.logger.info(f"✅ {saved}/{len(pending)} transcrições salvas na collection")
+        return saved
+    
     def save_transcription_to_collection(self, conversation_id: str, message_id: str, 
-                                       contact_name: str, transcription_data: Dict) -> bool:
+                                       contact_name: str, transcription_data: Dict,
+                                       db_service=None) -> bool:
         """Salvar transcrição na collection dedicada do MongoDB"""
         self._ensure_initialized()
         
         try:
-            from .database_service import DatabaseService
-            
-            # Inicializar serviço de banco
-            db_service = DatabaseService()
+            # Reutilizar serviço de banco (do chamador ou compartilhado)
+            db_service = db_service or self._get_db_service()
             
-            # Preparar dados para a collection
-            collection_data = {
-                "mensagem_id": message_id,
-                "user_id": conversation_id,  # Usando conversation_id como user_id por enquanto
-                "company_id": "default",     # Pode ser configurado depois
-                "server_name": "whatsapp",   # Pode ser configurado depois
-                "conversation_id": conversation_id,
-                "contact_name": contact_name,
-                "transcription": transcription_data,
-                "audio_duration": transcription_data.get("duration"),
-                "confidence": transcription_data.get("confidence"),
-                "whisper_model": Config.WHISPER_MODEL,
-                "device": self.device
-            }
+            collection_data = self._build_collection_data(
+                conversation_id, message_id, contact_name, transcription_data
+            )
             
             # Salvar na collection
             success = db_service.save_transcription_to_collection(collection_data)
@@ -301,12 +462,15 @@ class AudioService(BaseService):
             return False
     
     def process_audio_message(self, audio_msg: Dict, download_service, db_service, 
-                            show_progress=True) -> Dict:
-        """Processar uma mensagem de áudio completa (download + transcrição + salvamento)"""
+                            show_progress=True, pending_collection: Optional[List[Dict]] = None) -> Dict:
+        """Processar uma mensagem de áudio completa (download + transcrição + salvamento)
+        
+        Se `pending_collection` for informado, o documento da collection de transcrições é
+        acumulado nele para gravação em lote via save_transcriptions_to_collection.
+        """
         self._ensure_initialized()
         
         import time
-        from pathlib import Path
         
         message_id = audio_msg['message_id']
         file_url = audio_msg.get('file_url', '')
@@ -326,12 +490,17 @@ class AudioService(BaseService):
         
         try:
             # 1. Verificar se arquivo já existe localmente
-            from ..config import Config
             conv_dir = Config.DOWNLOADS_DIR / audio_msg['conversation_id']
-            extension = download_service._get_file_extension(audio_msg['file_url'])
+            extension = download_service._get_file_extension(file_url)
             local_file_path = conv_dir / f"{message_id}{extension}"
             
-            if local_file_path.exists():
+            # Um único stat: existência + tamanho
+            try:
+                file_size = os.stat(local_file_path).st_size
+            except FileNotFoundError:
+                file_size = None
+            
+            if file_size is not None:
                 if show_progress:
                     print(f"      📁 Arquivo já existe localmente: {local_file_path.name}")
                 audio_path = str(local_file_path)
@@ -356,8 +525,6 @@ class AudioService(BaseService):
                         
                         # Marcar como falha de download no MongoDB
                         try:
-                            from .database_service import DatabaseService
-                            db_service = DatabaseService()
                             db_service.mark_audio_download_failed(
                                 audio_msg['conversation_id'],
                                 audio_msg['contact_idx'],
@@ -379,8 +546,6 @@ class AudioService(BaseService):
                     
                     # Marcar como falha de download no MongoDB
                     try:
-                        from .database_service import DatabaseService
-                        db_service = DatabaseService()
                         db_service.mark_audio_download_failed(
                             audio_msg['conversation_id'],
                             audio_msg['contact_idx'],
@@ -398,8 +563,9 @@ class AudioService(BaseService):
                 if show_progress:
                     print(f"      ✅ Download concluído em {download_time:.1f}s")
             
-            # Verificar tamanho do arquivo
-            file_size = Path(audio_path).stat().st_size
+            # Verificar tamanho do arquivo (já conhecido se não houve download)
+            if file_size is None:
+                file_size = os.stat(audio_path).st_size
             if show_progress:
                 print(f"      📊 Tamanho: {file_size/1024:.1f}KB")
             
@@ -449,13 +615,21 @@ class AudioService(BaseService):
             )
             save_time = time.time() - save_start
             
-            # 4. Salvar na collection dedicada de transcrições
-            if success:
-                collection_success = self.save_transcription_to_collection(
+            # 4. Salvar na collection dedicada de transcrições (ou acumular para lote)
+            if success and pending_collection is not None:
+                pending_collection.append(self._build_collection_data(
                     audio_msg['conversation_id'],
                     str(audio_msg['message_id']),
                     audio_msg['contact_name'],
                     transcription_data
+                ))
+            elif success:
+                collection_success = self.save_transcription_to_collection(
+                    audio_msg['conversation_id'],
+                    str(audio_msg['message_id']),
+                    audio_msg['contact_name'],
+                    transcription_data,
+                    db_service=db_service
                 )
                 if not collection_success and show_progress:
                     print(f"      ⚠️ Aviso: Falha ao salvar na collection de transcrições")
@@ -484,3 +658,8 @@ class AudioService(BaseService):
             if show_progress:
                 print(f"      ❌ Erro: {e}")
             return result
+    
+    def _cleanup(self):
+        """Encerrar pool de transcrição"""
+        if hasattr(self, '_transcribe_executor'):
+            self._transcribe_executor.shutdown(wait=True)
@@ -1,22 +1,205 @@
 """
 Service para análise de conversas por contatos/atendentes
 """
-from datetime import datetime
-from typing import List, Dict, Optional, Any
-import json
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from operator import itemgetter
+from string import Template
+from typing import Any, Callable, Dict, List, Optional
+import copy
+import functools
+import hashlib
+import re
+import threading
+
+import orjson
+import pymongo
+from bson import ObjectId
 
 from .base_service import BaseService
 from .analysis_service import LlamaService
 from .database_service import DatabaseService
 from ..config import Config
 
+# Vírgulas finais antes de } ou ] (erro comum em JSON gerado por LLM)
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
+
+def _loads_lenient(candidate: str) -> Optional[Any]:
+    """orjson.loads com um único reparo (vírgulas finais) antes de desistir"""
+    try:
+        return orjson.loads(candidate)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        return orjson.loads(_TRAILING_COMMA_RE.sub(r'\1', candidate))
+    except orjson.JSONDecodeError:
+        return None
+
+
+def _is_json_object(response: str) -> bool:
+    """Resposta contém um objeto JSON válido"""
+    return isinstance(_extract_json(response), dict)
+
+
+def _is_json_list(response: str) -> bool:
+    """Resposta contém uma lista JSON válida"""
+    return isinstance(_extract_json(response, '['), list)
+
+
+def _safe_llm_analysis(label: str, default: Any):
+    """Decorator para as análises via LLM: registra a falha e retorna o valor padrão
+    
+    default pode ser um valor (copiado a cada falha) ou uma função que recebe a exceção.
+    """
+    def decorator(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            except Exception as e:
+                self.logger.error("Erro na %s: %s", label, e)
+                return default(e) if callable(default) else copy.deepcopy(default)
+        return wrapper
+    return decorator
+
+
+def _extract_json(text: str, opener: str = '{') -> Optional[Any]:
+    """Extrair o primeiro objeto ({) ou lista ([) JSON balanceado do texto
+    
+    Varredura linear contando profundidade e respeitando strings/escapes, sem o
+    backtracking da regex gulosa; ignora texto antes/depois e JSONs extras.
+    """
+    closer = '}' if opener == '{' else ']'
+    start = text.find(opener)
+    
+    while start != -1:
+        depth = 0
+        in_string = False
+        escape = False
+        
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif ch == '\\':
+                    escape = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == opener:
+                depth += 1
+            elif ch == closer:
+                depth -= 1
+                if depth == 0:
+                    parsed = _loads_lenient(text[start:i + 1])
+                    if parsed is not None:
+                        return parsed
+                    break
+        else:
+            # Estrutura não fechada até o fim do texto
+            return None
+        
+        start = text.find(opener, start + 1)
+    
+    return None
+
 class ContactAnalysisService(BaseService):
     """Service para análise detalhada de conversas por contatos"""
     
+    # Versão dos prompts - alterar invalida o cache de respostas (llm_prompt_cache)
+    PROMPT_VERSION = "3"
+    
+    # Máximo de respostas mantidas no cache em memória (antes do MongoDB)
+    MEMO_MAX_ENTRIES = 4096
+    
+    # Análises gravadas a cada N conversas em analyze_multiple_conversations
+    SAVE_BATCH_SIZE = 20
+    
+    # Prompt único com as 7 análises do contato (conversa enviada ao modelo uma só vez)
+    _PROMPT_COMBINED = Template("""
+Analise esta conversa de atendimento com ${contact_name} e produza, em um único objeto JSON,
+as sete análises descritas abaixo.
+
+Instruções:
+- "subject_analysis": assunto principal, tipo de atendimento (vendas, suporte, reclamação, etc.), produto/serviço, urgência e se é primeira interação ou follow-up
+- "sentiment_analysis": sentimento geral, emoções do cliente, tom do cliente e do atendente, pontos de tensão e de satisfação
+- "communication_style": clareza, formalidade, proatividade do atendente, follow-up, qualidade das explicações e eficiência das respostas
+- "service_quality": resolução do problema, empatia, proatividade em soluções, conhecimento técnico, personalização, esforço de retenção e nota de 1 a 10
+- "key_topics": até 5 tópicos principais, específicos e relevantes para o negócio
+- "action_items": promessas do atendente, ações do cliente, prazos e follow-ups necessários
+- "customer_satisfaction": nível e nota de satisfação, risco de churn, intenção de compra, feedback explícito e indicadores de lealdade
+- Responda APENAS com JSON válido, sem markdown
+
+FORMATO OBRIGATÓRIO (JSON):
+{
+    "subject_analysis": {
+        "main_subject": "assunto principal",
+        "service_type": "tipo de atendimento",
+        "product_service": "produto/serviço",
+        "urgency": "alta/media/baixa",
+        "interaction_type": "primeira/retorno",
+        "context": "contexto adicional"
+    },
+    "sentiment_analysis": {
+        "overall_sentiment": "positivo/neutro/negativo",
+        "sentiment_score": 0.0-1.0,
+        "customer_emotions": ["emoção1", "emoção2"],
+        "customer_tone": "descrição do tom",
+        "agent_tone": "descrição do tom",
+        "tension_points": ["ponto1", "ponto2"],
+        "satisfaction_indicators": ["indicador1", "indicador2"]
+    },
+    "communication_style": {
+        "communication_clarity": "excelente/bom/regular/ruim",
+        "formality_level": "formal/informal/adequado",
+        "agent_proactivity": "alta/média/baixa",
+        "follow_up_quality": "excelente/bom/regular/inexistente",
+        "explanation_quality": "excelente/bom/regular/ruim",
+        "response_efficiency": "rápido/adequado/lento",
+        "communication_highlights": ["ponto1", "ponto2"],
+        "improvement_areas": ["área1", "área2"]
+    },
+    "service_quality": {
+        "problem_resolved": "sim/parcialmente/não",
+        "empathy_level": "alta/média/baixa",
+        "solution_proactivity": "alta/média/baixa",
+        "technical_knowledge": "excelente/bom/regular/insuficiente",
+        "personalization": "alta/média/baixa",
+        "retention_effort": "alta/média/baixa",
+        "service_rating": 1-10,
+        "strengths": ["força1", "força2"],
+        "weaknesses": ["fraqueza1", "fraqueza2"]
+    },
+    "key_topics": ["tópico1", "tópico2", "tópico3"],
+    "action_items": [
+        {"action": "descrição da ação", "responsible": "atendente/cliente", "deadline": "prazo se mencionado", "status": "pendente/em_andamento/concluído"}
+    ],
+    "customer_satisfaction": {
+        "satisfaction_level": "muito_satisfeito/satisfeito/neutro/insatisfeito/muito_insatisfeito",
+        "satisfaction_score": 1-10,
+        "churn_risk": "baixo/médio/alto",
+        "purchase_intent": "alta/média/baixa/inexistente",
+        "explicit_feedback": "positivo/negativo/neutro/ausente",
+        "loyalty_indicators": ["indicador1", "indicador2"],
+        "satisfaction_factors": ["fator1", "fator2"]
+    }
+}
+
+Responda APENAS com o JSON:
+""")
+    
     def _initialize(self):
         """Inicializar services"""
         self.llama_service = LlamaService()
         self.db_service = DatabaseService()
+        self._memo: "OrderedDict[str, str]" = OrderedDict()
+        self._memo_lock = threading.Lock()
+        self._memo_hits = 0
+        self._memo_misses = 0
         self._ensure_llama_service_initialized()
     
     def _ensure_llama_service_initialized(self):
@@ -26,8 +209,11 @@ class ContactAnalysisService(BaseService):
         else:
             self.logger.error("LlamaService não foi inicializado")
     
-    def analyze_conversation_by_contacts(self, conversation_id: str) -> Dict[str, Any]:
-        """Analisar conversa por contatos individuais"""
+    def analyze_conversation_by_contacts(self, conversation_id: str, save: bool = True) -> Dict[str, Any]:
+        """Analisar conversa por contatos individuais
+        
+        Com save=False o resultado não é gravado (o chamador salva em lote).
+        """
         self._ensure_initialized()
         self._log_operation("análise por contatos", {"conversation_id": conversation_id})
         
@@ -37,12 +223,34 @@ class ContactAnalysisService(BaseService):
             if not conversation_data:
                 return {'error': 'Conversa não encontrada'}
             
-            # 2. Analisar cada contato individualmente
+            # 2. Analisar cada contato individualmente (chamadas ao Ollama em paralelo),
+            # uma única vez por transcrição idêntica
+            contacts = conversation_data.get('contacts', [])
+            unique = {}
+            contact_keys = []
+            for contact in contacts:
+                # Chave só pelas mensagens: o cabeçalho com o nome difere entre duplicatas
+                message_text = self._contact_message_text(contact)
+                key = hashlib.blake2b(message_text.encode(), digest_size=16).hexdigest()
+                contact_text = self._prepare_contact_text(contact, message_text)
+                unique.setdefault(key, (contact, contact_text))
+                contact_keys.append(key)
+            
+            with ThreadPoolExecutor(max_workers=max(1, Config.OLLAMA_NUM_PARALLEL)) as executor:
+                analyses = dict(zip(unique, executor.map(
+                    lambda item: self._analyze_single_contact(item[0], conversation_data, item[1]),
+                    unique.values()
+                )))
+            
             contact_analyses = []
-            for contact in conversation_data.get('contacts', []):
-                contact_analysis = self._analyze_single_contact(contact, conversation_data)
-                if contact_analysis:
-                    contact_analyses.append(contact_analysis)
+            for contact, key in zip(contacts, contact_keys):
+                analysis = analyses[key]
+                if not analysis:
+                    continue
+                if contact is not unique[key][0]:
+                    # Duplicata: reaproveitar análise, recalculando campos do contato
+                    analysis = {**copy.deepcopy(analysis), **self._contact_stats(contact)}
+                contact_analyses.append(analysis)
             
             # 3. Gerar análise geral da conversa
             overall_analysis = self._generate_overall_analysis(contact_analyses, conversation_data)
@@ -60,79 +268,220 @@ class ContactAnalysisService(BaseService):
             }
             
             # 5. Salvar no banco
-            self._save_contact_analysis(conversation_id, result)
+            if save:
+                self._save_contact_analysis(conversation_id, result)
             
-            self._log_success("análise por contatos", {"contacts_analyzed": len(contact_analyses)})
+            self._log_success("análise por contatos", {
+                "contacts_analyzed": len(contact_analyses),
+                "memo_hit_rate": self._memo_hit_rate()
+            })
             return result
             
         except Exception as e:
             self._log_error("análise por contatos", e)
             return {'error': str(e)}
     
-    def _analyze_single_contact(self, contact: Dict, conversation_data: Dict) -> Optional[Dict]:
+    def _analyze_single_contact(self, contact: Dict, conversation_data: Dict,
+                                contact_text: Optional[str] = None) -> Optional[Dict]:
         """Analisar um contato específico"""
         try:
-            contact_name = contact.get('contact_name', 'Desconhecido')
-            messages = contact.get('messages', [])
-            
-            if not messages:
+            if not contact.get('messages'):
                 return None
             
-            # Preparar texto da conversa com este contato
-            contact_text = self._prepare_contact_text(contact)
+            # Preparar texto da conversa com este contato (truncado uma vez para
+            # a janela de contexto, já que é reutilizado em todos os prompts)
+            if contact_text is None:
+                contact_text = self._prepare_contact_text(contact)
+            contact_text = self.llama_service._fit_to_context(contact_text)
+            
+            # Conversas curtas demais: não vale gastar chamadas ao Ollama
+            stats = self._contact_stats(contact)
+            if (stats['total_messages'] < Config.CONTACT_MIN_MESSAGES
+                    or len(contact_text) < Config.CONTACT_MIN_TEXT_CHARS):
+                return {**stats, **self._trivial_analysis()}
             
             # Análises específicas para atendentes
             analysis = {
-                'contact_name': contact_name,
-                'total_messages': len(messages),
-                'message_types': self._count_message_types(messages),
-                'conversation_duration': self._calculate_conversation_duration(messages),
-                'subject_analysis': self._analyze_subject(contact_text, contact_name),
-                'sentiment_analysis': self._analyze_sentiment(contact_text, contact_name),
-                'communication_style': self._analyze_communication_style(contact_text, contact_name),
-                'service_quality': self._analyze_service_quality(contact_text, contact_name),
-                'key_topics': self._extract_key_topics(contact_text, contact_name),
-                'action_items': self._extract_action_items(contact_text, contact_name),
-                'customer_satisfaction': self._analyze_customer_satisfaction(contact_text, contact_name)
+                **stats,
+                **self._analyze_contact_combined(contact_text, stats['contact_name'])
             }
             
             return analysis
             
         except Exception as e:
-            self.logger.error(f"Erro ao analisar contato {contact.get('contact_name', 'Desconhecido')}: {e}")
+            self.logger.error("Erro ao analisar contato %s: %s", contact.get('contact_name', 'Desconhecido'), e)
             return None
     
-    def _prepare_contact_text(self, contact: Dict) -> str:
-        """Preparar texto da conversa com um contato específico"""
-        contact_name = contact.get('contact_name', 'Desconhecido')
+    def _trivial_analysis(self) -> Dict[str, Any]:
+        """Análise padrão para contatos com dados insuficientes (sem chamar o LLM)
+        
+        Omite notas numéricas para não distorcer as médias da análise geral.
+        """
+        marker = {"insufficient_data": True}
+        return {
+            'insufficient_data': True,
+            'subject_analysis': {**marker, "main_subject": "Dados insuficientes"},
+            'sentiment_analysis': {**marker, "overall_sentiment": "indeterminado"},
+            'communication_style': dict(marker),
+            'service_quality': dict(marker),
+            'key_topics': [],
+            'action_items': [],
+            'customer_satisfaction': {**marker, "satisfaction_level": "indeterminado"}
+        }
+    
+    def _contact_stats(self, contact: Dict) -> Dict[str, Any]:
+        """Campos da análise que dependem apenas das mensagens do contato"""
         messages = contact.get('messages', [])
+        return {
+            'contact_name': contact.get('contact_name', 'Desconhecido'),
+            'total_messages': len(messages),
+            'message_types': self._count_message_types(messages),
+            'conversation_duration': self._calculate_conversation_duration(messages)
+        }
+    
+    def _analyze_contact_combined(self, contact_text: str, contact_name: str) -> Dict[str, Any]:
+        """Executar as 7 análises do contato em uma única chamada ao Ollama
         
-        text_parts = [f"=== Conversa com {contact_name} ==="]
+        Campos ausentes ou com tipo inválido na resposta são refeitos com o prompt
+        individual correspondente (que mantém seus próprios valores padrão).
+        """
+        prompt = self._build_task_prompt(
+            contact_text,
+            self._PROMPT_COMBINED.substitute(contact_name=contact_name)
+        )
         
-        for message in messages:
-            text = message.get('text', '')
-            timestamp = message.get('timestamp', '')
-            message_type = message.get('message_type', 'text')
-            
-            if text:
-                prefix = f"[{timestamp}] " if timestamp else ""
-                if message_type == 'audio':
-                    prefix += "[ÁUDIO] "
-                
-                text_parts.append(f"{prefix}{text}")
+        try:
+            response = self._cached_call(prompt, "combined", response_format="json", task="contact_combined",
+                                         validate=_is_json_object)
+            data = _extract_json(response)
+            if not isinstance(data, dict):
+                data = {}
+        except Exception as e:
+            self.logger.warning("⚠️ Análise combinada do contato falhou, usando prompts individuais: %s", e)
+            data = {}
         
-        return "\n".join(text_parts)
+        if isinstance(data.get('key_topics'), list):
+            data['key_topics'] = [str(topic).strip() for topic in data['key_topics'] if str(topic).strip()][:5]
+        
+        # Campo -> (tipo esperado, prompt individual usado como fallback)
+        fields = {
+            'subject_analysis': (dict, self._analyze_subject),
+            'sentiment_analysis': (dict, self._analyze_sentiment),
+            'communication_style': (dict, self._analyze_communication_style),
+            'service_quality': (dict, self._analyze_service_quality),
+            'key_topics': (list, self._extract_key_topics),
+            'action_items': (list, self._extract_action_items),
+            'customer_satisfaction': (dict, self._analyze_customer_satisfaction)
+        }
+        
+        results = {}
+        for field, (expected_type, fallback) in fields.items():
+            value = data.get(field)
+            if isinstance(value, expected_type) and (value or field == 'action_items'):
+                results[field] = value
+            else:
+                results[field] = fallback(contact_text, contact_name)
+        
+        return results
+    
+    def _build_task_prompt(self, contact_text: str, task_instructions: str) -> str:
+        """Montar prompt com a conversa primeiro e a tarefa no final
+        
+        O prefixo (conversa) é idêntico em todas as análises do contato, permitindo que o
+        Ollama reaproveite o cache KV do prefill entre as chamadas.
+        """
+        return f"Conversa:\n{contact_text}\n\n---TAREFA---\n{task_instructions.lstrip()}"
+    
+    def _cached_call(self, prompt: str, tag: str, response_format: Optional[str] = None,
+                     task: Optional[str] = None,
+                     validate: Optional[Callable[[str], bool]] = None) -> str:
+        """Chamar Ollama consultando antes o cache em memória e o do MongoDB
+        
+        Chave: hash de tarefa + versão do prompt + modelo + formato + opções + prompt completo.
+        O task seleciona as opções de amostragem em LlamaService.TASK_OPTIONS.
+        Só respostas aprovadas por validate (padrão: não vazias) vão para o cache, para
+        que uma geração truncada ou inválida não seja repetida até o TTL expirar.
+        Falhas no cache não impedem a chamada ao modelo.
+        """
+        key_source = "|".join([tag, self.PROMPT_VERSION, self.llama_service.model, response_format or "", task or "", prompt])
+        key = hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
+        
+        with self._memo_lock:
+            response = self._memo.get(key)
+            if response is not None:
+                self._memo.move_to_end(key)
+                self._memo_hits += 1
+                return response
+            self._memo_misses += 1
+        
+        cache = self.db_service.db.llm_prompt_cache
+        
+        try:
+            cached = cache.find_one({"_id": key}, {"response": 1})
+            if cached:
+                self.logger.debug("🎯 Cache hit (%s): %s", tag, key[:12])
+                self._memoize(key, cached["response"])
+                return cached["response"]
+        except Exception as e:
+            self.logger.warning("⚠️ Erro ao consultar cache de prompts: %s", e)
+        
+        response = self.llama_service._call_ollama(prompt, response_format=response_format, task=task)
+        if not (validate(response) if validate else response.strip()):
+            self.logger.debug("⚠️ Resposta inválida não armazenada em cache (%s)", tag)
+            return response
+        
+        self._memoize(key, response)
+        
+        try:
+            cache.update_one(
+                {"_id": key},
+                {"$set": {"tag": tag, "response": response, "created_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+        except Exception as e:
+            self.logger.warning("⚠️ Erro ao gravar cache de prompts: %s", e)
+        
+        return response
+    
+    def _memoize(self, key: str, response: str):
+        """Guardar resposta no cache em memória (LRU)"""
+        with self._memo_lock:
+            self._memo[key] = response
+            self._memo.move_to_end(key)
+            if len(self._memo) > self.MEMO_MAX_ENTRIES:
+                self._memo.popitem(last=False)
+    
+    def _memo_hit_rate(self) -> float:
+        """Taxa de acerto do cache em memória"""
+        total = self._memo_hits + self._memo_misses
+        return round(self._memo_hits / total, 3) if total else 0.0
+    
+    def _prepare_contact_text(self, contact: Dict, message_text: Optional[str] = None) -> str:
+        """Preparar texto da conversa com um contato específico"""
+        contact_name = contact.get('contact_name', 'Desconhecido')
+        if message_text is None:
+            message_text = self._contact_message_text(contact)
+        
+        return f"=== Conversa com {contact_name} ===\n{message_text}"
+    
+    def _contact_message_text(self, contact: Dict) -> str:
+        """Linhas de mensagens do contato, sem o cabeçalho com o nome"""
+        messages = contact.get('messages', [])
+        
+        return "\n".join(
+            f"{f'[{timestamp}] ' if timestamp else ''}{'[ÁUDIO] ' if message_type == 'audio' else ''}{text}"
+            for message in messages
+            for text, timestamp, message_type in [(
+                message.get('text', ''), message.get('timestamp', ''), message.get('message_type', 'text')
+            )]
+            if text
+        )
     
     def _count_message_types(self, messages: List[Dict]) -> Dict[str, int]:
         """Contar tipos de mensagens"""
-        types = {'text': 0, 'audio': 0, 'total': len(messages)}
-        
-        for message in messages:
-            msg_type = message.get('message_type', 'text')
-            if msg_type in types:
-                types[msg_type] += 1
+        counts = Counter(message.get('message_type', 'text') for message in messages)
         
-        return types
+        return {'text': counts['text'], 'audio': counts['audio'], 'total': len(messages)}
     
     def _calculate_conversation_duration(self, messages: List[Dict]) -> Dict[str, Any]:
         """Calcular duração da conversa"""
@@ -145,27 +494,33 @@ class ContactAnalysisService(BaseService):
             return {'duration_minutes': 0, 'first_message': timestamps[0] if timestamps else None, 'last_message': timestamps[0] if timestamps else None}
         
         try:
-            from datetime import datetime
-            first = datetime.fromisoformat(timestamps[0].replace('Z', '+00:00'))
-            last = datetime.fromisoformat(timestamps[-1].replace('Z', '+00:00'))
+            # Mínimo/máximo reais (mensagens podem vir fora de ordem)
+            parsed = [(datetime.fromisoformat(ts.replace('Z', '+00:00')), ts) for ts in timestamps]
+            first, first_raw = min(parsed, key=itemgetter(0))
+            last, last_raw = max(parsed, key=itemgetter(0))
             duration = (last - first).total_seconds() / 60
             
             return {
                 'duration_minutes': round(duration, 1),
-                'first_message': timestamps[0],
-                'last_message': timestamps[-1]
+                'first_message': first_raw,
+                'last_message': last_raw
             }
         except:
             return {'duration_minutes': 0, 'first_message': timestamps[0], 'last_message': timestamps[-1]}
     
+    @_safe_llm_analysis("análise de assunto", lambda e: {
+        "main_subject": "Erro na análise",
+        "service_type": "Erro na análise",
+        "product_service": "Erro na análise",
+        "urgency": "média",
+        "interaction_type": "primeira",
+        "context": str(e)
+    })
     def _analyze_subject(self, contact_text: str, contact_name: str) -> Dict[str, Any]:
         """Analisar assunto principal da conversa"""
-        prompt = f"""
+        prompt = self._build_task_prompt(contact_text, """
 Analise esta conversa de atendimento e identifique o assunto principal e contexto.
 
-Conversa:
-{contact_text}
-
 Instruções:
 - Identifique o assunto principal da conversa
 - Classifique o tipo de atendimento (vendas, suporte, reclamação, etc.)
@@ -174,51 +529,46 @@ Instruções:
 - Identifique se é primeira interação ou follow-up
 
 Responda em formato JSON:
-{{
+{
     "main_subject": "assunto principal",
     "service_type": "tipo de atendimento",
     "product_service": "produto/serviço",
     "urgency": "alta/media/baixa",
     "interaction_type": "primeira/retorno",
     "context": "contexto adicional"
-}}
-"""
+}
+""")
         
-        try:
-            response = self.llama_service._call_ollama(prompt)
-            # Tentar extrair JSON da resposta
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return {
-                    "main_subject": "Não identificado",
-                    "service_type": "Não identificado",
-                    "product_service": "Não identificado",
-                    "urgency": "média",
-                    "interaction_type": "primeira",
-                    "context": response[:200] + "..." if len(response) > 200 else response
-                }
-        except Exception as e:
-            self.logger.error(f"Erro na análise de assunto: {e}")
+        response = self._cached_call(prompt, "subject", response_format="json", task="contact_json",
+                                     validate=_is_json_object)
+        # Tentar extrair JSON da resposta
+        parsed = _extract_json(response)
+        if parsed is not None:
+            return parsed
+        else:
             return {
-                "main_subject": "Erro na análise",
-                "service_type": "Erro na análise",
-                "product_service": "Erro na análise",
+                "main_subject": "Não identificado",
+                "service_type": "Não identificado",
+                "product_service": "Não identificado",
                 "urgency": "média",
                 "interaction_type": "primeira",
-                "context": str(e)
+                "context": response[:200] + "..." if len(response) > 200 else response
             }
     
+    @_safe_llm_analysis("análise de sentimento", {
+        "overall_sentiment": "neutro",
+        "sentiment_score": 0.5,
+        "customer_emotions": ["erro"],
+        "customer_tone": "erro na análise",
+        "agent_tone": "erro na análise",
+        "tension_points": [],
+        "satisfaction_indicators": []
+    })
     def _analyze_sentiment(self, contact_text: str, contact_name: str) -> Dict[str, Any]:
         """Analisar sentimento da conversa"""
-        prompt = f"""
+        prompt = self._build_task_prompt(contact_text, """
 Analise o sentimento e tom desta conversa de atendimento.
 
-Conversa:
-{contact_text}
-
 Instruções:
 - Analise o sentimento geral (positivo, neutro, negativo)
 - Identifique emoções específicas (satisfação, frustração, urgência, etc.)
@@ -227,7 +577,7 @@ Instruções:
 - Identifique pontos de tensão ou satisfação
 
 Responda em formato JSON:
-{{
+{
     "overall_sentiment": "positivo/neutro/negativo",
     "sentiment_score": 0.0-1.0,
     "customer_emotions": ["emoção1", "emoção2"],
@@ -235,45 +585,40 @@ Responda em formato JSON:
     "agent_tone": "descrição do tom",
     "tension_points": ["ponto1", "ponto2"],
     "satisfaction_indicators": ["indicador1", "indicador2"]
-}}
-"""
+}
+""")
         
-        try:
-            response = self.llama_service._call_ollama(prompt)
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return {
-                    "overall_sentiment": "neutro",
-                    "sentiment_score": 0.5,
-                    "customer_emotions": ["neutro"],
-                    "customer_tone": "neutro",
-                    "agent_tone": "profissional",
-                    "tension_points": [],
-                    "satisfaction_indicators": []
-                }
-        except Exception as e:
-            self.logger.error(f"Erro na análise de sentimento: {e}")
+        response = self._cached_call(prompt, "sentiment", response_format="json", task="contact_json",
+                                     validate=_is_json_object)
+        parsed = _extract_json(response)
+        if parsed is not None:
+            return parsed
+        else:
             return {
                 "overall_sentiment": "neutro",
                 "sentiment_score": 0.5,
-                "customer_emotions": ["erro"],
-                "customer_tone": "erro na análise",
-                "agent_tone": "erro na análise",
+                "customer_emotions": ["neutro"],
+                "customer_tone": "neutro",
+                "agent_tone": "profissional",
                 "tension_points": [],
                 "satisfaction_indicators": []
             }
     
+    @_safe_llm_analysis("análise de comunicação", {
+        "communication_clarity": "erro",
+        "formality_level": "erro",
+        "agent_proactivity": "erro",
+        "follow_up_quality": "erro",
+        "explanation_quality": "erro",
+        "response_efficiency": "erro",
+        "communication_highlights": [],
+        "improvement_areas": []
+    })
     def _analyze_communication_style(self, contact_text: str, contact_name: str) -> Dict[str, Any]:
         """Analisar estilo de comunicação"""
-        prompt = f"""
+        prompt = self._build_task_prompt(contact_text, """
 Analise o estilo de comunicação nesta conversa de atendimento.
 
-Conversa:
-{contact_text}
-
 Instruções:
 - Avalie a clareza das comunicações
 - Identifique o nível de formalidade
@@ -283,7 +628,7 @@ Instruções:
 - Avalie tempo de resposta (se possível)
 
 Responda em formato JSON:
-{{
+{
     "communication_clarity": "excelente/bom/regular/ruim",
     "formality_level": "formal/informal/adequado",
     "agent_proactivity": "alta/média/baixa",
@@ -292,47 +637,42 @@ Responda em formato JSON:
     "response_efficiency": "rápido/adequado/lento",
     "communication_highlights": ["ponto1", "ponto2"],
     "improvement_areas": ["área1", "área2"]
-}}
-"""
+}
+""")
         
-        try:
-            response = self.llama_service._call_ollama(prompt)
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return {
-                    "communication_clarity": "bom",
-                    "formality_level": "adequado",
-                    "agent_proactivity": "média",
-                    "follow_up_quality": "bom",
-                    "explanation_quality": "bom",
-                    "response_efficiency": "adequado",
-                    "communication_highlights": [],
-                    "improvement_areas": []
-                }
-        except Exception as e:
-            self.logger.error(f"Erro na análise de comunicação: {e}")
+        response = self._cached_call(prompt, "communication_style", response_format="json", task="contact_json",
+                                     validate=_is_json_object)
+        parsed = _extract_json(response)
+        if parsed is not None:
+            return parsed
+        else:
             return {
-                "communication_clarity": "erro",
-                "formality_level": "erro",
-                "agent_proactivity": "erro",
-                "follow_up_quality": "erro",
-                "explanation_quality": "erro",
-                "response_efficiency": "erro",
+                "communication_clarity": "bom",
+                "formality_level": "adequado",
+                "agent_proactivity": "média",
+                "follow_up_quality": "bom",
+                "explanation_quality": "bom",
+                "response_efficiency": "adequado",
                 "communication_highlights": [],
                 "improvement_areas": []
             }
     
+    @_safe_llm_analysis("análise de qualidade", {
+        "problem_resolved": "erro",
+        "empathy_level": "erro",
+        "solution_proactivity": "erro",
+        "technical_knowledge": "erro",
+        "personalization": "erro",
+        "retention_effort": "erro",
+        "service_rating": 0,
+        "strengths": [],
+        "weaknesses": []
+    })
     def _analyze_service_quality(self, contact_text: str, contact_name: str) -> Dict[str, Any]:
         """Analisar qualidade do atendimento"""
-        prompt = f"""
+        prompt = self._build_task_prompt(contact_text, """
 Avalie a qualidade do atendimento nesta conversa.
 
-Conversa:
-{contact_text}
-
 Instruções:
 - Avalie se o problema foi resolvido
 - Verifique se o atendente foi empático
@@ -342,7 +682,7 @@ Instruções:
 - Identifique se houve esforço para reter o cliente
 
 Responda em formato JSON:
-{{
+{
     "problem_resolved": "sim/parcialmente/não",
     "empathy_level": "alta/média/baixa",
     "solution_proactivity": "alta/média/baixa",
@@ -352,49 +692,33 @@ Responda em formato JSON:
     "service_rating": 1-10,
     "strengths": ["força1", "força2"],
     "weaknesses": ["fraqueza1", "fraqueza2"]
-}}
-"""
+}
+""")
         
-        try:
-            response = self.llama_service._call_ollama(prompt)
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return {
-                    "problem_resolved": "não identificado",
-                    "empathy_level": "média",
-                    "solution_proactivity": "média",
-                    "technical_knowledge": "bom",
-                    "personalization": "média",
-                    "retention_effort": "média",
-                    "service_rating": 7,
-                    "strengths": [],
-                    "weaknesses": []
-                }
-        except Exception as e:
-            self.logger.error(f"Erro na análise de qualidade: {e}")
+        response = self._cached_call(prompt, "service_quality", response_format="json", task="contact_json",
+                                     validate=_is_json_object)
+        parsed = _extract_json(response)
+        if parsed is not None:
+            return parsed
+        else:
             return {
-                "problem_resolved": "erro",
-                "empathy_level": "erro",
-                "solution_proactivity": "erro",
-                "technical_knowledge": "erro",
-                "personalization": "erro",
-                "retention_effort": "erro",
-                "service_rating": 0,
+                "problem_resolved": "não identificado",
+                "empathy_level": "média",
+                "solution_proactivity": "média",
+                "technical_knowledge": "bom",
+                "personalization": "média",
+                "retention_effort": "média",
+                "service_rating": 7,
                 "strengths": [],
                 "weaknesses": []
             }
     
+    @_safe_llm_analysis("extração de tópicos", ["Erro na análise de tópicos"])
     def _extract_key_topics(self, contact_text: str, contact_name: str) -> List[str]:
         """Extrair tópicos principais da conversa"""
-        prompt = f"""
+        prompt = self._build_task_prompt(contact_text, """
 Extraia os tópicos principais desta conversa de atendimento.
 
-Conversa:
-{contact_text}
-
 Instruções:
 - Liste os principais tópicos discutidos
 - Máximo 5 tópicos
@@ -402,24 +726,18 @@ Instruções:
 - Foque em aspectos relevantes para o negócio
 
 Responda apenas com uma lista, um tópico por linha:
-"""
+""")
         
-        try:
-            response = self.llama_service._call_ollama(prompt)
-            topics = [topic.strip() for topic in response.split('\n') if topic.strip()]
-            return topics[:5]  # Limitar a 5 tópicos
-        except Exception as e:
-            self.logger.error(f"Erro na extração de tópicos: {e}")
-            return ["Erro na análise de tópicos"]
+        response = self._cached_call(prompt, "key_topics", task="contact_list")
+        topics = [topic.strip() for topic in response.split('\n') if topic.strip()]
+        return topics[:5]  # Limitar a 5 tópicos
     
+    @_safe_llm_analysis("extração de ações", [])
     def _extract_action_items(self, contact_text: str, contact_name: str) -> List[Dict[str, str]]:
         """Extrair itens de ação da conversa"""
-        prompt = f"""
+        prompt = self._build_task_prompt(contact_text, """
 Identifique ações ou compromissos assumidos nesta conversa de atendimento.
 
-Conversa:
-{contact_text}
-
 Instruções:
 - Identifique promessas feitas pelo atendente
 - Identifique ações que o cliente precisa tomar
@@ -428,31 +746,32 @@ Instruções:
 
 Responda em formato JSON:
 [
-    {{"action": "descrição da ação", "responsible": "atendente/cliente", "deadline": "prazo se mencionado", "status": "pendente/em_andamento/concluído"}},
+    {"action": "descrição da ação", "responsible": "atendente/cliente", "deadline": "prazo se mencionado", "status": "pendente/em_andamento/concluído"},
     ...
 ]
-"""
+""")
         
-        try:
-            response = self.llama_service._call_ollama(prompt)
-            import re
-            json_match = re.search(r'\[.*\]', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return []
-        except Exception as e:
-            self.logger.error(f"Erro na extração de ações: {e}")
+        response = self._cached_call(prompt, "action_items", task="contact_json", validate=_is_json_list)
+        parsed = _extract_json(response, '[')
+        if parsed is not None:
+            return parsed
+        else:
             return []
     
+    @_safe_llm_analysis("análise de satisfação", {
+        "satisfaction_level": "erro",
+        "satisfaction_score": 0,
+        "churn_risk": "erro",
+        "purchase_intent": "erro",
+        "explicit_feedback": "erro",
+        "loyalty_indicators": [],
+        "satisfaction_factors": []
+    })
     def _analyze_customer_satisfaction(self, contact_text: str, contact_name: str) -> Dict[str, Any]:
         """Analisar satisfação do cliente"""
-        prompt = f"""
+        prompt = self._build_task_prompt(contact_text, """
 Avalie a satisfação do cliente nesta conversa de atendimento.
 
-Conversa:
-{contact_text}
-
 Instruções:
 - Identifique indicadores de satisfação ou insatisfação
 - Avalie se o cliente ficou satisfeito com a solução
@@ -461,7 +780,7 @@ Instruções:
 - Identifique feedback positivo ou negativo explícito
 
 Responda em formato JSON:
-{{
+{
     "satisfaction_level": "muito_satisfeito/satisfeito/neutro/insatisfeito/muito_insatisfeito",
     "satisfaction_score": 1-10,
     "churn_risk": "baixo/médio/alto",
@@ -469,33 +788,21 @@ Responda em formato JSON:
     "explicit_feedback": "positivo/negativo/neutro/ausente",
     "loyalty_indicators": ["indicador1", "indicador2"],
     "satisfaction_factors": ["fator1", "fator2"]
-}}
-"""
+}
+""")
         
-        try:
-            response = self.llama_service._call_ollama(prompt)
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return {
-                    "satisfaction_level": "neutro",
-                    "satisfaction_score": 5,
-                    "churn_risk": "médio",
-                    "purchase_intent": "média",
-                    "explicit_feedback": "ausente",
-                    "loyalty_indicators": [],
-                    "satisfaction_factors": []
-                }
-        except Exception as e:
-            self.logger.error(f"Erro na análise de satisfação: {e}")
+        response = self._cached_call(prompt, "customer_satisfaction", response_format="json", task="contact_json",
+                                     validate=_is_json_object)
+        parsed = _extract_json(response)
+        if parsed is not None:
+            return parsed
+        else:
             return {
-                "satisfaction_level": "erro",
-                "satisfaction_score": 0,
-                "churn_risk": "erro",
-                "purchase_intent": "erro",
-                "explicit_feedback": "erro",
+                "satisfaction_level": "neutro",
+                "satisfaction_score": 5,
+                "churn_risk": "médio",
+                "purchase_intent": "média",
+                "explicit_feedback": "ausente",
                 "loyalty_indicators": [],
                 "satisfaction_factors": []
             }
@@ -505,19 +812,33 @@ Responda em formato JSON:
         if not contact_analyses:
             return {"error": "Nenhuma análise de contato disponível"}
         
-        # Agregar dados de todas as análises
-        total_messages = sum(ca['total_messages'] for ca in contact_analyses)
-        total_duration = sum(ca['conversation_duration']['duration_minutes'] for ca in contact_analyses)
+        # Agregar dados de todas as análises em uma única passada (acumuladores)
+        total_messages = 0
+        total_duration = 0
+        sentiment_sum = service_sum = satisfaction_sum = 0.0
+        sentiment_count = service_count = satisfaction_count = 0
         
-        # Calcular médias
-        avg_sentiment_scores = [ca['sentiment_analysis']['sentiment_score'] for ca in contact_analyses if 'sentiment_score' in ca['sentiment_analysis']]
-        avg_sentiment = sum(avg_sentiment_scores) / len(avg_sentiment_scores) if avg_sentiment_scores else 0.5
-        
-        service_ratings = [ca['service_quality']['service_rating'] for ca in contact_analyses if 'service_rating' in ca['service_quality']]
-        avg_service_rating = sum(service_ratings) / len(service_ratings) if service_ratings else 5
+        for ca in contact_analyses:
+            total_messages += ca['total_messages']
+            total_duration += ca['conversation_duration']['duration_minutes']
+            
+            sentiment = ca['sentiment_analysis']
+            if 'sentiment_score' in sentiment:
+                sentiment_sum += sentiment['sentiment_score']
+                sentiment_count += 1
+            service = ca['service_quality']
+            if 'service_rating' in service:
+                service_sum += service['service_rating']
+                service_count += 1
+            satisfaction = ca['customer_satisfaction']
+            if 'satisfaction_score' in satisfaction:
+                satisfaction_sum += satisfaction['satisfaction_score']
+                satisfaction_count += 1
         
-        satisfaction_scores = [ca['customer_satisfaction']['satisfaction_score'] for ca in contact_analyses if 'satisfaction_score' in ca['customer_satisfaction']]
-        avg_satisfaction = sum(satisfaction_scores) / len(satisfaction_scores) if satisfaction_scores else 5
+        # Calcular médias
+        avg_sentiment = sentiment_sum / sentiment_count if sentiment_count else 0.5
+        avg_service_rating = service_sum / service_count if service_count else 5
+        avg_satisfaction = satisfaction_sum / satisfaction_count if satisfaction_count else 5
         
         return {
             "total_contacts": len(contact_analyses),
@@ -563,7 +884,7 @@ Resumo Executivo:
                 "priority_actions": self._identify_priority_actions(contact_analyses)
             }
         except Exception as e:
-            self.logger.error(f"Erro na geração do resumo executivo: {e}")
+            self.logger.error("Erro na geração do resumo executivo: %s", e)
             return {
                 "executive_summary": "Erro na geração do resumo",
                 "key_insights": ["Erro na análise"],
@@ -589,7 +910,9 @@ Resumo Executivo:
             recommendations.append("Aumentar proatividade na oferta de soluções")
         
         # Recomendações baseadas em satisfação
-        low_satisfaction = [ca for ca in contact_analyses if ca.get('customer_satisfaction', {}).get('satisfaction_score', 5) < 6]
+        low_satisfaction = [ca for ca in contact_analyses
+                            if not ca.get('insufficient_data')
+                            and ca.get('customer_satisfaction', {}).get('satisfaction_score', 5) < 6]
         if low_satisfaction:
             recommendations.append("Investigar casos de baixa satisfação do cliente")
         
@@ -634,14 +957,43 @@ Resumo Executivo:
             
             # Salvar também no documento da conversa
             self.db_service.db.diarios.update_one(
-                {"_id": self.db_service.ObjectId(conversation_id)},
+                {"_id": ObjectId(conversation_id)},
                 {"$set": {"contact_analysis": analysis_result}}
             )
             
-            self.logger.info(f"✅ Análise de contatos salva para conversa {conversation_id}")
+            self.logger.info("✅ Análise de contatos salva para conversa %s", conversation_id)
             
         except Exception as e:
-            self.logger.error(f"❌ Erro ao salvar análise de contatos: {e}")
+            self.logger.error("❌ Erro ao salvar análise de contatos: %s", e)
+    
+    def _save_contact_analyses_bulk(self, analysis_results: List[Dict]):
+        """Salvar várias análises no banco com um bulk_write por coleção
+        
+        Cada coleção é gravada de forma independente: falha em uma não impede a outra.
+        """
+        if not analysis_results:
+            return
+        
+        analyses_ops = []
+        diarios_ops = []
+        for result in analysis_results:
+            conversation_id = result['conversation_id']
+            analyses_ops.append(pymongo.UpdateOne(
+                {"conversation_id": conversation_id},
+                {"$set": result},
+                upsert=True
+            ))
+            diarios_ops.append(pymongo.UpdateOne(
+                {"_id": ObjectId(conversation_id)},
+                {"$set": {"contact_analysis": result}}
+            ))
+        
+        for collection, operations in (("contact_analyses", analyses_ops), ("diarios", diarios_ops)):
+            try:
+                self.db_service.db[collection].bulk_write(operations, ordered=False)
+                self.logger.info("✅ %d análises de contatos salvas em lote (%s)", len(operations), collection)
+            except Exception as e:
+                self.logger.error("❌ Erro ao salvar análises de contatos em lote (%s): %s", collection, e)
     
     def get_contact_analysis(self, conversation_id: str) -> Optional[Dict]:
         """Buscar análise de contatos existente"""
@@ -649,7 +1001,7 @@ Resumo Executivo:
             analysis = self.db_service.db.contact_analyses.find_one({"conversation_id": conversation_id})
             return analysis
         except Exception as e:
-            self.logger.error(f"Erro ao buscar análise de contatos: {e}")
+            self.logger.error("Erro ao buscar análise de contatos: %s", e)
             return None
     
     def analyze_multiple_conversations(self, conversation_ids: List[str]) -> Dict[str, Any]:
@@ -659,19 +1011,30 @@ Resumo Executivo:
         
         results = []
         successful = 0
-        failed = 0
         
-        for conv_id in conversation_ids:
-            try:
-                analysis = self.analyze_conversation_by_contacts(conv_id)
-                if 'error' not in analysis:
+        # Descartar IDs inválidos antes de gastar chamadas ao Ollama
+        valid_ids = [conv_id for conv_id in conversation_ids if ObjectId.is_valid(conv_id)]
+        failed = len(conversation_ids) - len(valid_ids)
+        if failed:
+            self.logger.warning("⚠️ %d IDs de conversa inválidos ignorados", failed)
+        
+        # Conversas em paralelo: sobrepõe I/O do Ollama/MongoDB entre conversas
+        # Gravação em lotes de SAVE_BATCH_SIZE: uma falha no meio não perde o que já foi analisado
+        pending_save = []
+        with ThreadPoolExecutor(max_workers=max(1, Config.OLLAMA_NUM_PARALLEL)) as executor:
+            for analysis in executor.map(self._analyze_conversation_safe, valid_ids):
+                if analysis is not None and 'error' not in analysis:
                     results.append(analysis)
+                    pending_save.append(analysis)
                     successful += 1
                 else:
                     failed += 1
-            except Exception as e:
-                self.logger.error(f"Erro ao analisar conversa {conv_id}: {e}")
-                failed += 1
+                
+                if len(pending_save) >= self.SAVE_BATCH_SIZE:
+                    self._save_contact_analyses_bulk(pending_save)
+                    pending_save = []
+        
+        self._save_contact_analyses_bulk(pending_save)
         
         return {
             "total_conversations": len(conversation_ids),
@@ -679,3 +1042,11 @@ Resumo Executivo:
             "failed_analyses": failed,
             "results": results
         }
+    
+    def _analyze_conversation_safe(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Analisar uma conversa sem propagar exceções (uso em threads)"""
+        try:
+            return self.analyze_conversation_by_contacts(conversation_id, save=False)
+        except Exception as e:
+            self.logger.error("Erro ao analisar conversa %s: %s", conversation_id, e)
+            return None
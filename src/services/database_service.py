@@ -1,23 +1,279 @@
 """
 Service para operações de banco de dados MongoDB
 """
+import atexit
+import functools
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import bson
 import pymongo
 from bson import ObjectId
-from datetime import datetime
-from typing import List, Dict, Optional, Any
+from pymongo import ReturnDocument
+from pymongo.read_preferences import ReadPreference
+from typing import Callable, List, Dict, Iterator, Optional, Any, Tuple
 
 from .base_service import BaseService
 from ..config import Config
 
+# Extensões de áudio na URL (mesmas verificadas em _is_audio_message)
+_AUDIO_URL_REGEX = r"\.(mp3|wav|ogg|m4a|oga)$"
+_AUDIO_URL_RE = re.compile(_AUDIO_URL_REGEX)
+
+# Extensões de imagem na URL (mesmas verificadas em _is_image_message)
+_IMAGE_URL_REGEX = r"\.(jpg|jpeg|png|gif|bmp|webp)$"
+_IMAGE_URL_RE = re.compile(_IMAGE_URL_REGEX)
+
+# Mensagem de áudio (equivalente em query de _is_audio_message)
+_AUDIO_MESSAGE_MATCH = {
+    "$or": [
+        {"media_type": "audio"},
+        {"is_audio": True},
+        {"type": "audio"},
+        {"media_url": {"$regex": _AUDIO_URL_REGEX}},
+        {"direct_media_url": {"$regex": _AUDIO_URL_REGEX}}
+    ]
+}
+
+# Áudio pendente: sem transcrição e status diferente de completed
+_PENDING_AUDIO_MATCH = {
+    "$and": [
+        _AUDIO_MESSAGE_MATCH,
+        {"audio_transcription": {"$in": [None, ""]}},
+        {"transcription_status": {"$ne": "completed"}}
+    ]
+}
+
+# Mensagem de imagem (equivalente em query de _is_image_message)
+_IMAGE_MESSAGE_MATCH = {
+    "$or": [
+        {"media_type": "image"},
+        {"is_image": True},
+        {"type": "image"},
+        {"media_url": {"$regex": _IMAGE_URL_REGEX}},
+        {"direct_media_url": {"$regex": _IMAGE_URL_REGEX}}
+    ]
+}
+
+# Imagem pendente: sem análise e status diferente de completed
+_PENDING_IMAGE_MATCH = {
+    "$and": [
+        _IMAGE_MESSAGE_MATCH,
+        {"image_analysis": {"$in": [None, ""]}},
+        {"image_analysis_status": {"$ne": "completed"}}
+    ]
+}
+
+# Sem transcrição (equivalente em query de _has_transcription negado)
+_NO_TRANSCRIPTION_MATCH = {
+    "$and": [
+        {"audio_transcription": {"$in": [None, ""]}},
+        {"transcription": {"$in": [None, ""]}},
+        {"transcription_text": {"$in": [None, ""]}}
+    ]
+}
+
+# Sem análise de imagem (equivalente em query de _has_image_analysis negado)
+_NO_IMAGE_ANALYSIS_MATCH = {
+    "$and": [
+        {"image_analysis": {"$in": [None, ""]}},
+        {"image_description": {"$in": [None, ""]}},
+        {"image_transcription": {"$in": [None, ""]}}
+    ]
+}
+
+# Download sem falha (equivalente em query de _is_download_failed negado)
+_DOWNLOAD_OK_MATCH = {
+    "$and": [
+        {"download_status": {"$ne": "failed"}},
+        {"download_error": {"$in": [None, "", False]}},
+        {"file_not_found": {"$in": [None, "", False]}},
+        {"404_error": {"$in": [None, "", False]}}
+    ]
+}
+
+# Campos da mensagem lidos por _is_audio_message e pela contagem de transcrições
+_AUDIO_FLAG_FIELDS = ("media_type", "type", "is_audio", "media_url", "direct_media_url",
+                      "transcription_status")
+
+# Projeção para status de processamento de áudio (campos da conversa + flags das mensagens)
+_AUDIO_STATUS_PROJECTION = {
+    "audio_processing_status": 1,
+    "audio_processing_completed_at": 1,
+    "audio_processing_stats": 1,
+    **{f"contacts.messages.{field}": 1 for field in _AUDIO_FLAG_FIELDS}
+}
+
+# created_at/updated_at carimbados pelo relógio do servidor ($currentDate) nas collections dedicadas
+_TIMESTAMPS_UPDATE = {"created_at": True, "updated_at": True}
+
+# Campos da mensagem usados por _create_audio_info/_create_image_info
+_MEDIA_INFO_FIELDS = ("_id", "created_at", "body", "direct_media_url", "download_url",
+                      "media_url", "file_url", "file_path")
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_oid(conversation_id: str) -> ObjectId:
+    """ObjectId a partir da string (memoizado: o mesmo ID é convertido várias vezes por conversa)"""
+    return ObjectId(conversation_id)
+
+
+def _prefix_match(match: Any, prefix: str) -> Any:
+    """Prefixar campos de um filtro de query (ex: para usar após $unwind)"""
+    if isinstance(match, dict):
+        # Operadores lógicos ($and/$or) são percorridos; campos recebem o prefixo
+        return {
+            (key if key.startswith('$') else f"{prefix}{key}"):
+                (_prefix_match(value, prefix) if key.startswith('$') else value)
+            for key, value in match.items()
+        }
+    if isinstance(match, list):
+        return [_prefix_match(item, prefix) for item in match]
+    return match
+
+def _media_message_expr(var: str, media: str, url_regex: str) -> Dict:
+    """Expressão de agregação que identifica mensagens de um tipo de mídia na variável $$var"""
+    def url_matches(field: str) -> Dict:
+        return {"$regexMatch": {"input": {"$ifNull": [f"$${var}.{field}", ""]}, "regex": url_regex}}
+    
+    return {"$or": [
+        {"$eq": [f"$${var}.media_type", media]},
+        {"$eq": [f"$${var}.is_{media}", True]},
+        {"$eq": [f"$${var}.type", media]},
+        url_matches("media_url"),
+        url_matches("direct_media_url")
+    ]}
+
+
+def _audio_message_expr(var: str) -> Dict:
+    """Expressão de agregação equivalente a _is_audio_message para a variável $$var"""
+    return _media_message_expr(var, "audio", _AUDIO_URL_REGEX)
+
+
+def _image_message_expr(var: str) -> Dict:
+    """Expressão de agregação equivalente a _is_image_message para a variável $$var"""
+    return _media_message_expr(var, "image", _IMAGE_URL_REGEX)
+
+
+def _media_items_expr(message_expr: Callable[[str], Dict]) -> Dict:
+    """Expressão de agregação com as mensagens de todos os contatos que casam com message_expr"""
+    return {"$filter": {
+        "input": {"$reduce": {
+            "input": {"$ifNull": ["$contacts", []]},
+            "initialValue": [],
+            "in": {"$concatArrays": ["$$value", {"$ifNull": ["$$this.messages", []]}]}
+        }},
+        "as": "m",
+        "cond": message_expr("m")
+    }}
+
+
+def _completed_count_expr(items: Dict, status_field: str) -> Dict:
+    """Quantidade de itens de items com status_field == completed"""
+    return {"$size": {"$filter": {
+        "input": items,
+        "as": "i",
+        "cond": {"$eq": [f"$$i.{status_field}", "completed"]}
+    }}}
+
+
+def _truthy_expr(expr: Any) -> Dict:
+    """Veracidade no estilo Python (em agregação, string vazia é verdadeira)"""
+    return {"$and": [expr, {"$ne": [expr, ""]}]}
+
+
+def _analysis_message_expr(var: str) -> Dict:
+    """Mensagem no formato de análise (equivalente a _get_message_content/_get_message_type)"""
+    transcription = f"$${var}.audio_transcription"
+    analysis = f"$${var}.image_analysis"
+    body = f"$${var}.body"
+    image_text = {"$cond": [
+        {"$eq": [{"$type": analysis}, "object"]},
+        {"$ifNull": [f"{analysis}.description", {"$ifNull": [f"{analysis}.text", ""]}]},
+        ""
+    ]}
+    
+    return {
+        "timestamp": f"$${var}.created_at",
+        "text": {"$switch": {
+            "branches": [
+                {"case": _truthy_expr(transcription),
+                 "then": {"$concat": ["[ÁUDIO TRANSCRITO] ", {"$toString": transcription}]}},
+                {"case": {"$and": [_truthy_expr(analysis), _truthy_expr(image_text)]},
+                 "then": {"$concat": ["[IMAGEM ANALISADA] ", {"$toString": image_text}]}}
+            ],
+            "default": {"$cond": [_truthy_expr(body), body, {"$ifNull": [f"$${var}.text", ""]}]}
+        }},
+        "message_type": {"$switch": {
+            "branches": [
+                {"case": _truthy_expr(transcription), "then": "audio_transcribed"},
+                {"case": _truthy_expr(analysis), "then": "image_analyzed"},
+                {"case": _audio_message_expr(var), "then": "audio"},
+                {"case": _image_message_expr(var), "then": "image"}
+            ],
+            "default": "text"
+        }},
+        "original_type": {"$ifNull": [f"$${var}.type", {"$ifNull": [f"$${var}.media_type", "text"]}]},
+        "has_transcription": _truthy_expr(transcription),
+        "has_image_analysis": _truthy_expr(analysis)
+    }
+
 class DatabaseService(BaseService):
     """Service para operações MongoDB"""
     
+    # MongoClient único por processo, compartilhado por todas as instâncias/threads
+    _shared_client: Optional[pymongo.MongoClient] = None
+    _client_lock = threading.Lock()
+    
+    # Cache de get_conversation_stats compartilhado entre instâncias: (monotonic, stats)
+    _stats_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+    
+    # Cache LRU de get_conversation_text_for_analysis: oid -> (monotonic, texto)
+    _conversation_cache: "OrderedDict[ObjectId, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+    _conversation_cache_lock = threading.RLock()
+    
     def _initialize(self):
-        """Inicializar conexão MongoDB"""
-        self.client = pymongo.MongoClient(Config.MONGODB_URI)
+        """Inicializar conexão MongoDB (reutiliza o cliente do processo)"""
+        cls = DatabaseService
+        with cls._client_lock:
+            if cls._shared_client is None:
+                client = pymongo.MongoClient(
+                    Config.MONGODB_URI,
+                    maxPoolSize=Config.MONGODB_MAX_POOL_SIZE,
+                    minPoolSize=Config.MONGODB_MIN_POOL_SIZE,
+                    maxIdleTimeMS=Config.MONGODB_MAX_IDLE_TIME_MS,
+                    serverSelectionTimeoutMS=Config.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                    compressors=Config.MONGODB_COMPRESSORS,
+                    retryWrites=True
+                )
+                self.client = client
+                self.db = client[Config.MONGODB_DATABASE]
+                try:
+                    self._test_connection()
+                except Exception:
+                    client.close()
+                    raise
+                self._create_indexes()
+                
+                # Sem as extensões C a (de)codificação BSON roda em Python puro, várias vezes mais lenta
+                if not (bson.has_c() and pymongo.has_c()):
+                    self.logger.warning("⚠️ Extensões C do PyMongo/BSON indisponíveis: decodificação em Python puro")
+                
+                cls._shared_client = client
+                atexit.register(client.close)
+        
+        self.client = cls._shared_client
         self.db = self.client[Config.MONGODB_DATABASE]
-        self._test_connection()
-        self._create_indexes()
+        # Relatórios somente leitura podem ser servidos por secundários
+        self._diarios_reports = self.db.diarios.with_options(
+            read_preference=ReadPreference.SECONDARY_PREFERRED
+        )
+    
+    def _as_oid(self, conversation_id: Any) -> ObjectId:
+        """Converter ID para ObjectId (aceita ObjectId já convertido)"""
+        return conversation_id if isinstance(conversation_id, ObjectId) else _parse_oid(conversation_id)
     
     def _test_connection(self):
         """Testar conexão com MongoDB"""
@@ -47,72 +303,148 @@ class DatabaseService(BaseService):
             self.db.image_analyses.create_index("created_at")
             self.db.image_analyses.create_index([("user_id", 1), ("created_at", -1)])
             
+            # Cache de respostas do LLM (expira automaticamente)
+            self.db.llm_prompt_cache.create_index("created_at", expireAfterSeconds=Config.LLM_CACHE_TTL_SECONDS)
+            
             self.logger.info("✅ Índices criados para collections de transcrições e análises de imagem")
         except Exception as e:
             self.logger.warning(f"⚠️ Erro ao criar índices: {e}")
+        
+        self._create_diarios_indexes()
+    
+    def _create_diarios_indexes(self):
+        """Criar índices da collection diarios (cada um isolado: falha em um não impede os demais)"""
+        indexes = [
+            # Busca de conversas com áudios (flag has_audio gravada por update_audio_flag);
+            # ordem ESR: igualdade em has_audio antes do intervalo ($ne) no status
+            [("has_audio", 1), ("audio_processing_status", 1)],
+            # Filtros por status de processamento
+            [("audio_processing_status", 1)],
+            [("image_processing_status", 1)],
+            # Multikey: predicados por mensagem (tipo de mídia e status de transcrição)
+            [("contacts.messages.media_type", 1)],
+            [("contacts.messages.transcription_status", 1)],
+        ]
+        
+        for keys in indexes:
+            try:
+                self.db.diarios.create_index(keys)
+            except pymongo.errors.OperationFailure as e:
+                self.logger.warning(f"⚠️ Erro ao criar índice {keys} em diarios: {e}")
     
     def get_conversations_with_pending_audios(self, limit: int = 100) -> List[Dict]:
         """Buscar conversas com áudios pendentes"""
+        return list(self.iter_conversations_with_pending_audios(limit))
+    
+    def iter_conversations_with_pending_audios(self, limit: int = 100,
+                                               batch_size: int = 20) -> Iterator[Dict]:
+        """Iterar conversas com áudios pendentes sem carregar todas em memória
+        
+        O cursor busca batch_size documentos por vez no servidor.
+        """
         self._ensure_initialized()
         self._log_operation("busca de conversas pendentes", {"limit": limit})
         
         query = {
-            # Excluir conversas já processadas
+            # Conversas com áudio (campo indexado, gravado por update_audio_flag) ainda não processadas
+            "has_audio": True,
             "audio_processing_status": {"$ne": "completed"},
-            # Buscar conversas com áudios
-            "$or": [
-                {"audio_messages": {"$gt": 0}},
-                {"media_messages": {"$gt": 0}},
-                {"contacts.messages.type": "audio"},
-                {"contacts.messages.media_type": "audio"}
-            ]
+            # Apenas conversas com pelo menos um áudio realmente pendente (filtro no servidor)
+            "contacts": {"$elemMatch": {"messages": {"$elemMatch": _PENDING_AUDIO_MATCH}}}
         }
         
         try:
-            cursor = self.db.diarios.find(query).limit(limit)
-            conversations = []
+            # Mensagens ficam de fora: os chamadores usam só os campos da conversa
+            # e buscam os áudios com get_pending_audios_for_conversation
+            cursor = self.db.diarios.find(query, {"contacts.messages": 0}).limit(limit).batch_size(batch_size)
+            found = 0
             
             for conv in cursor:
-                # Verificar se realmente tem áudios pendentes
-                has_pending_audios = self._has_pending_audios(conv)
-                if has_pending_audios:
-                    conv["_id"] = str(conv["_id"])
-                    conversations.append(conv)
+                conv["_id"] = str(conv["_id"])
+                found += 1
+                yield conv
             
-            self._log_success("busca de conversas pendentes", {"encontradas": len(conversations)})
-            return conversations
+            self._log_success("busca de conversas pendentes", {"encontradas": found})
             
         except Exception as e:
             self._log_error("busca de conversas pendentes", e)
             raise
     
-    def get_conversations_with_pending_images(self, limit: int = 100) -> List[Dict]:
-        """Buscar conversas com imagens pendentes"""
+    def update_audio_flag(self, conversation_id: str) -> bool:
+        """Gravar has_audio de uma conversa (chamar na ingestão ou quando as mensagens mudam)
+        
+        Avaliado no servidor em um único update, sem trazer as mensagens.
+        """
+        self._ensure_initialized()
+        
+        try:
+            audios = _media_items_expr(_audio_message_expr)
+            self.db.diarios.update_one(
+                {"_id": self._as_oid(conversation_id)},
+                [{"$set": {"has_audio": {"$or": [
+                    {"$gt": [{"$ifNull": ["$audio_messages", 0]}, 0]},
+                    {"$gt": [{"$size": audios}, 0]}
+                ]}}}]
+            )
+            return True
+        except Exception as e:
+            self.logger.error(f"Erro ao atualizar flag has_audio: {e}")
+            return False
+    
+    def refresh_audio_flags(self) -> int:
+        """Recalcular has_audio em toda a collection (migração / manutenção)
+        
+        Varre a collection inteira e escreve no primário: executar apenas sob demanda
+        (manage_system.py refresh-flags), nunca em caminhos de leitura.
+        """
+        self._ensure_initialized()
+        
+        try:
+            has_audio_match = [
+                {"audio_messages": {"$gt": 0}},
+                {"contacts.messages": {"$elemMatch": _AUDIO_MESSAGE_MATCH}}
+            ]
+            flagged = self.db.diarios.update_many(
+                {"has_audio": {"$ne": True}, "$or": has_audio_match},
+                {"$set": {"has_audio": True}}
+            )
+            # Só marca False o que realmente não tem áudio (predicado reavaliado no servidor)
+            self.db.diarios.update_many(
+                {"has_audio": {"$exists": False}, "$nor": has_audio_match},
+                {"$set": {"has_audio": False}}
+            )
+            
+            self.logger.info(f"🏷️ {flagged.modified_count} conversas marcadas com has_audio")
+            return flagged.modified_count
+        except Exception as e:
+            self.logger.error(f"Erro ao recalcular flags has_audio: {e}")
+            return 0
+    
+    def get_conversations_with_pending_images(self, limit: int = 100, batch_size: int = 20) -> List[Dict]:
+        """Buscar conversas com imagens pendentes
+        
+        O cursor busca batch_size documentos por vez: mais round trips, mas sem
+        acumular lotes de vários MB no driver antes de chegarem ao Python.
+        """
         self._ensure_initialized()
         self._log_operation("busca de conversas com imagens pendentes", {"limit": limit})
         
         query = {
             # Excluir conversas já processadas
             "image_processing_status": {"$ne": "completed"},
-            # Buscar conversas com imagens
-            "$or": [
-                {"image_messages": {"$gt": 0}},
-                {"media_messages": {"$gt": 0}},
-                {"contacts.messages.type": "image"},
-                {"contacts.messages.media_type": "image"}
-            ]
+            # Apenas conversas com pelo menos uma imagem realmente pendente (filtro no servidor)
+            "contacts": {"$elemMatch": {"messages": {"$elemMatch": _PENDING_IMAGE_MATCH}}}
         }
         
         try:
-            cursor = self.db.diarios.find(query).limit(limit)
             conversations = []
             
+            # Mensagens ficam de fora: os chamadores usam só os campos da conversa
+            # e buscam as imagens com get_pending_images_for_conversation
+            cursor = self.db.diarios.find(query, {"contacts.messages": 0}).limit(limit).batch_size(batch_size)
             for conv in cursor:
-                # Verificar se realmente tem imagens pendentes
-                has_pending_images = self._has_pending_images(conv)
-                if has_pending_images:
-                    conv["_id"] = str(conv["_id"])
-                    conversations.append(conv)
+                conv["_id"] = str(conv["_id"])
+                conversations.append(conv)
             
             self._log_success("busca de conversas com imagens pendentes", {"encontradas": len(conversations)})
             return conversations
@@ -121,32 +453,23 @@ class DatabaseService(BaseService):
             self._log_error("busca de conversas com imagens pendentes", e)
             raise
 
-    def _has_pending_audios(self, conversation: Dict) -> bool:
-        """Verificar se a conversa tem áudios pendentes de processamento"""
-        try:
-            for contact in conversation.get('contacts', []):
-                for message in contact.get('messages', []):
-                    if self._is_audio_message(message):
-                        # Se não tem transcrição ou status não é completed
-                        if (not message.get('audio_transcription') and 
-                            message.get('transcription_status') != 'completed'):
-                            return True
-            return False
-        except Exception:
-            return False
-    
-    def _has_pending_images(self, conversation: Dict) -> bool:
-        """Verificar se a conversa tem imagens pendentes de processamento"""
+    def has_pending_audios(self, conversation_id: str) -> bool:
+        """Verificar no servidor se a conversa ainda tem áudios pendentes
+        
+        Só o _id volta do servidor: nenhuma mensagem é decodificada no cliente.
+        """
+        self._ensure_initialized()
+        
         try:
-            for contact in conversation.get('contacts', []):
-                for message in contact.get('messages', []):
-                    if self._is_image_message(message):
-                        # Se não tem análise ou status não é completed
-                        if (not message.get('image_analysis') and 
-                            message.get('image_analysis_status') != 'completed'):
-                            return True
-            return False
-        except Exception:
+            return self.db.diarios.find_one(
+                {
+                    "_id": self._as_oid(conversation_id),
+                    "contacts": {"$elemMatch": {"messages": {"$elemMatch": _PENDING_AUDIO_MATCH}}}
+                },
+                {"_id": 1}
+            ) is not None
+        except Exception as e:
+            self.logger.error(f"Erro ao verificar áudios pendentes: {e}")
             return False
     
     def get_pending_audios_for_conversation(self, conversation_id: str) -> List[Dict]:
@@ -155,25 +478,13 @@ class DatabaseService(BaseService):
         self._log_operation("extração de áudios pendentes", {"conversation_id": conversation_id})
         
         try:
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
-            if not conversation:
-                return []
-            
-            pending_audios = []
-            contacts = conversation.get('contacts', [])
-            
-            for contact_idx, contact in enumerate(contacts):
-                messages = contact.get('messages', [])
-                
-                for msg_idx, message in enumerate(messages):
-                    if (self._is_audio_message(message) and 
-                        not self._has_transcription(message) and 
-                        not self._is_download_failed(message)):
-                        audio_info = self._create_audio_info(
-                            conversation_id, contact_idx, msg_idx, 
-                            message, contact
-                        )
-                        pending_audios.append(audio_info)
+            pending_audios = [
+                self._create_audio_info(
+                    conversation_id, doc['contact_idx'], doc['message_idx'],
+                    doc.get('message', {}), {'contact_name': doc.get('contact_name', 'Desconhecido')}
+                )
+                for doc in self.get_pending_audios_pipeline(conversation_id)
+            ]
             
             self._log_success("extração de áudios pendentes", {"encontrados": len(pending_audios)})
             return pending_audios
@@ -182,29 +493,53 @@ class DatabaseService(BaseService):
             self._log_error("extração de áudios pendentes", e)
             return []
     
+    def get_pending_audios_pipeline(self, conversation_id: str) -> List[Dict]:
+        """Localizar áudios pendentes no servidor via aggregation"""
+        return self._messages_pipeline(
+            conversation_id,
+            {"$and": [_AUDIO_MESSAGE_MATCH, _NO_TRANSCRIPTION_MATCH, _DOWNLOAD_OK_MATCH]}
+        )
+    
+    def _messages_pipeline(self, conversation_id: str, message_match: Dict) -> List[Dict]:
+        """Localizar mensagens de uma conversa que casam com message_match
+        
+        Retorna apenas contact_idx, message_idx, contact_name e os campos da
+        mensagem necessários para _create_audio_info/_create_image_info
+        (sem trafegar a conversa inteira).
+        """
+        message_prefix = "contacts.messages."
+        pipeline = [
+            {"$match": {"_id": self._as_oid(conversation_id)}},
+            {"$project": {"contacts.contact_name": 1, "contacts.messages": 1}},
+            {"$unwind": {"path": "$contacts", "includeArrayIndex": "contact_idx"}},
+            {"$unwind": {"path": "$contacts.messages", "includeArrayIndex": "message_idx"}},
+            {"$match": _prefix_match(message_match, message_prefix)},
+            {"$project": {
+                "_id": 0,
+                "contact_idx": 1,
+                "message_idx": 1,
+                "contact_name": "$contacts.contact_name",
+                **{f"message.{field}": f"${message_prefix}{field}" for field in _MEDIA_INFO_FIELDS}
+            }}
+        ]
+        return list(self.db.diarios.aggregate(pipeline))
+    
     def get_pending_images_for_conversation(self, conversation_id: str) -> List[Dict]:
         """Extrair imagens pendentes de uma conversa"""
         self._ensure_initialized()
         self._log_operation("extração de imagens pendentes", {"conversation_id": conversation_id})
         
         try:
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
-            if not conversation:
-                return []
-            
-            pending_images = []
-            contacts = conversation.get('contacts', [])
-            
-            for contact_idx, contact in enumerate(contacts):
-                messages = contact.get('messages', [])
-                
-                for msg_idx, message in enumerate(messages):
-                    if self._is_image_message(message) and not self._has_image_analysis(message):
-                        image_info = self._create_image_info(
-                            conversation_id, contact_idx, msg_idx, 
-                            message, contact
-                        )
-                        pending_images.append(image_info)
+            # Apenas as imagens sem análise saem do servidor
+            pending_images = [
+                self._create_image_info(
+                    conversation_id, doc['contact_idx'], doc['message_idx'],
+                    doc.get('message', {}), {'contact_name': doc.get('contact_name', 'Desconhecido')}
+                )
+                for doc in self._messages_pipeline(
+                    conversation_id, {"$and": [_IMAGE_MESSAGE_MATCH, _NO_IMAGE_ANALYSIS_MATCH]}
+                )
+            ]
             
             self._log_success("extração de imagens pendentes", {"encontradas": len(pending_images)})
             return pending_images
@@ -219,23 +554,14 @@ class DatabaseService(BaseService):
         self._log_operation("busca de todos os áudios", {"conversation_id": conversation_id})
         
         try:
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
-            if not conversation:
-                return []
-            
-            all_audios = []
-            contacts = conversation.get('contacts', [])
-            
-            for contact_idx, contact in enumerate(contacts):
-                messages = contact.get('messages', [])
-                
-                for msg_idx, message in enumerate(messages):
-                    if self._is_audio_message(message):
-                        audio_info = self._create_audio_info(
-                            conversation_id, contact_idx, msg_idx, 
-                            message, contact
-                        )
-                        all_audios.append(audio_info)
+            # Apenas as mensagens de áudio saem do servidor
+            all_audios = [
+                self._create_audio_info(
+                    conversation_id, doc['contact_idx'], doc['message_idx'],
+                    doc.get('message', {}), {'contact_name': doc.get('contact_name', 'Desconhecido')}
+                )
+                for doc in self._messages_pipeline(conversation_id, _AUDIO_MESSAGE_MATCH)
+            ]
             
             self._log_success("extração de todos os áudios", {"encontrados": len(all_audios)})
             return all_audios
@@ -257,13 +583,15 @@ class DatabaseService(BaseService):
         try:
             # Atualizar mensagem com status de falha
             result = self.db.diarios.update_one(
-                {"_id": ObjectId(conversation_id)},
+                {"_id": self._as_oid(conversation_id)},
                 {
                     "$set": {
                         f"contacts.{contact_idx}.messages.{message_idx}.download_status": "failed",
                         f"contacts.{contact_idx}.messages.{message_idx}.download_error": error_message,
-                        f"contacts.{contact_idx}.messages.{message_idx}.download_failed_at": datetime.now(),
                         f"contacts.{contact_idx}.messages.{message_idx}.404_error": "404" in error_message
+                    },
+                    "$currentDate": {
+                        f"contacts.{contact_idx}.messages.{message_idx}.download_failed_at": True
                     }
                 }
             )
@@ -282,23 +610,14 @@ class DatabaseService(BaseService):
         self._log_operation("busca de todas as imagens", {"conversation_id": conversation_id})
         
         try:
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
-            if not conversation:
-                return []
-            
-            all_images = []
-            contacts = conversation.get('contacts', [])
-            
-            for contact_idx, contact in enumerate(contacts):
-                messages = contact.get('messages', [])
-                
-                for msg_idx, message in enumerate(messages):
-                    if self._is_image_message(message):
-                        image_info = self._create_image_info(
-                            conversation_id, contact_idx, msg_idx, 
-                            message, contact
-                        )
-                        all_images.append(image_info)
+            # Apenas as mensagens de imagem saem do servidor
+            all_images = [
+                self._create_image_info(
+                    conversation_id, doc['contact_idx'], doc['message_idx'],
+                    doc.get('message', {}), {'contact_name': doc.get('contact_name', 'Desconhecido')}
+                )
+                for doc in self._messages_pipeline(conversation_id, _IMAGE_MESSAGE_MATCH)
+            ]
             
             self._log_success("extração de todas as imagens", {"encontradas": len(all_images)})
             return all_images
@@ -309,23 +628,25 @@ class DatabaseService(BaseService):
     
     def _is_audio_message(self, message: Dict) -> bool:
         """Verificar se mensagem é áudio"""
-        return (
-            message.get('media_type') == 'audio' or
-            message.get('is_audio', False) or
-            message.get('type') == 'audio' or
-            str(message.get('media_url', '')).endswith(('.mp3', '.wav', '.ogg', '.m4a', '.oga')) or
-            str(message.get('direct_media_url', '')).endswith(('.mp3', '.wav', '.ogg', '.m4a', '.oga'))
-        )
+        # Comparações baratas primeiro; regex só quando necessário
+        if message.get('media_type') == 'audio' or message.get('type') == 'audio' or message.get('is_audio'):
+            return True
+        for field in ('media_url', 'direct_media_url'):
+            url = message.get(field)
+            if isinstance(url, str) and _AUDIO_URL_RE.search(url):
+                return True
+        return False
     
     def _is_image_message(self, message: Dict) -> bool:
         """Verificar se mensagem é imagem"""
-        return (
-            message.get('media_type') == 'image' or
-            message.get('is_image', False) or
-            message.get('type') == 'image' or
-            str(message.get('media_url', '')).endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff')) or
-            str(message.get('direct_media_url', '')).endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff'))
-        )
+        # Comparações baratas primeiro; regex só quando necessário
+        if message.get('media_type') == 'image' or message.get('type') == 'image' or message.get('is_image'):
+            return True
+        for field in ('media_url', 'direct_media_url'):
+            url = message.get(field)
+            if isinstance(url, str) and _IMAGE_URL_RE.search(url):
+                return True
+        return False
     
     def _has_transcription(self, message: Dict) -> bool:
         """Verificar se mensagem já tem transcrição"""
@@ -410,24 +731,24 @@ class DatabaseService(BaseService):
         })
         
         try:
-            result = self.db.diarios.update_one(
-                {"_id": ObjectId(conversation_id)},
-                {
-                    "$set": {
-                        f"contacts.{contact_idx}.messages.{message_idx}.audio_transcription": transcription["text"],
-                        f"contacts.{contact_idx}.messages.{message_idx}.transcription_data": transcription,
-                        f"contacts.{contact_idx}.messages.{message_idx}.transcription_status": "completed",
-                        f"contacts.{contact_idx}.messages.{message_idx}.transcribed_at": datetime.now(),
-                        "updated_at": datetime.now()
-                    }
-                }
-            )
+            # Gravar a transcrição e reavaliar o status da conversa em um único round trip
+            # (as operações do bulk são executadas em ordem no servidor)
+            conversation_oid = self._as_oid(conversation_id)
+            result = self.db.diarios.bulk_write([
+                pymongo.UpdateOne(
+                    {"_id": conversation_oid},
+                    self._transcription_update(contact_idx, message_idx, transcription)
+                ),
+                self._conversation_status_update(conversation_oid)
+            ])
+            self._invalidate_conversation_cache(conversation_oid)
             
             success = result.modified_count > 0
             
-            # Verificar se todos os áudios da conversa foram processados
-            if success:
-                self._check_and_update_conversation_status(conversation_id)
+            # Segunda operação modificada: todos os áudios da conversa foram processados
+            if result.modified_count > 1:
+                self.logger.info(f"✅ Conversa {conversation_id} marcada como processada")
+                self._invalidate_stats_cache()
             
             self._log_success("atualização de transcrição", {"modified": result.modified_count})
             return success
@@ -436,6 +757,162 @@ class DatabaseService(BaseService):
             self._log_error("atualização de transcrição", e)
             return False
     
+    def update_audio_transcription_with_progress(self, conversation_id: str, contact_idx: int,
+                                                 message_idx: int, transcription: Dict) -> Dict[str, Any]:
+        """Atualizar transcrição de áudio e retornar o progresso da conversa
+        
+        Usa find_one_and_update com a projeção de status, evitando um
+        get_processing_status separado para acompanhar o progresso.
+        """
+        self._log_operation("atualização de transcrição com progresso", {
+            "conversation_id": conversation_id,
+            "contact_idx": contact_idx,
+            "message_idx": message_idx
+        })
+        
+        try:
+            conversation_oid = self._as_oid(conversation_id)
+            conversation = self.db.diarios.find_one_and_update(
+                {"_id": conversation_oid},
+                self._transcription_update(contact_idx, message_idx, transcription),
+                projection=_AUDIO_STATUS_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+            self._invalidate_conversation_cache(conversation_oid)
+            if not conversation:
+                return {"success": False, "error": "Conversa não encontrada"}
+            
+            total_audios, processed_audios = self._count_audio_progress(conversation)
+            status = conversation.get('audio_processing_status', 'pending')
+            
+            # Último áudio transcrito: marcar a conversa como processada
+            if total_audios and processed_audios == total_audios and status != 'completed':
+                result = self.db.diarios.bulk_write([self._conversation_status_update(conversation_oid)])
+                if result.modified_count:
+                    status = 'completed'
+                    self.logger.info(f"✅ Conversa {conversation_id} marcada como processada")
+                    self._invalidate_stats_cache()
+            
+            progress = {
+                "success": True,
+                "conversation_id": conversation_id,
+                "audio_processing_status": status,
+                "total_audios": total_audios,
+                "processed_audios": processed_audios,
+                "completion_percentage": (processed_audios / total_audios * 100) if total_audios > 0 else 0
+            }
+            self._log_success("atualização de transcrição com progresso", {
+                "processed": f"{processed_audios}/{total_audios}"
+            })
+            return progress
+            
+        except Exception as e:
+            self._log_error("atualização de transcrição com progresso", e)
+            return {"success": False, "error": str(e)}
+    
+    def _transcription_update(self, contact_idx: int, message_idx: int, transcription: Dict) -> Dict:
+        """Documento de update que grava a transcrição de uma mensagem"""
+        prefix = f"contacts.{contact_idx}.messages.{message_idx}"
+        return {
+            "$set": {
+                f"{prefix}.audio_transcription": transcription["text"],
+                f"{prefix}.transcription_data": transcription,
+                f"{prefix}.transcription_status": "completed",
+                # Mensagem transcrita é áudio: mantém a flag correta mesmo sem a ingestão marcá-la
+                "has_audio": True
+            },
+            # Datas carimbadas pelo relógio do servidor
+            "$currentDate": {f"{prefix}.transcribed_at": True, "updated_at": True}
+        }
+    
+    def _count_audio_progress(self, conversation: Dict) -> Tuple[int, int]:
+        """Contar áudios e áudios já transcritos de uma conversa"""
+        total_audios = 0
+        processed_audios = 0
+        
+        for contact in conversation.get('contacts', []):
+            for message in contact.get('messages', []):
+                if self._is_audio_message(message):
+                    total_audios += 1
+                    if message.get('transcription_status') == 'completed':
+                        processed_audios += 1
+        
+        return total_audios, processed_audios
+    
+    def update_audio_transcriptions(self, updates: List[Dict]) -> int:
+        """Atualizar várias transcrições de áudio em lote
+        
+        Cada item contém conversation_id, contact_idx, message_idx e transcription.
+        Usa um bulk_write para as mensagens e outro para reavaliar o status das
+        conversas afetadas. Retorna o número de mensagens atualizadas.
+        """
+        if not updates:
+            return 0
+        
+        self._log_operation("atualização de transcrições em lote", {"count": len(updates)})
+        
+        try:
+            conversation_oids = [self._as_oid(update["conversation_id"]) for update in updates]
+            message_ops = [
+                pymongo.UpdateOne(
+                    {"_id": conversation_oid},
+                    self._transcription_update(update["contact_idx"], update["message_idx"], update["transcription"])
+                )
+                for conversation_oid, update in zip(conversation_oids, updates)
+            ]
+            modified, completed = self._bulk_update_messages(
+                message_ops, conversation_oids, self._conversation_status_update
+            )
+            
+            if completed:
+                self._invalidate_stats_cache()
+            
+            self._log_success("atualização de transcrições em lote", {
+                "modified": modified,
+                "conversations_completed": completed
+            })
+            return modified
+            
+        except Exception as e:
+            self._log_error("atualização de transcrições em lote", e)
+            return 0
+    
+    def _bulk_update_messages(self, message_ops: List[pymongo.UpdateOne], conversation_oids: List[ObjectId],
+                              status_update: Callable[[ObjectId], pymongo.UpdateOne]) -> Tuple[int, int]:
+        """Gravar updates de mensagens em lote e reavaliar o status das conversas afetadas
+        
+        Em falha parcial (BulkWriteError) as mensagens gravadas continuam contando, e o
+        status e o cache das conversas tocadas são atualizados mesmo assim.
+        Retorna (mensagens modificadas, conversas concluídas).
+        """
+        # dict como conjunto ordenado: uma reavaliação de status por conversa
+        conversation_oids = list(dict.fromkeys(conversation_oids))
+        
+        try:
+            modified = self.db.diarios.bulk_write(message_ops, ordered=False).modified_count
+        except pymongo.errors.BulkWriteError as e:
+            details = e.details or {}
+            modified = details.get("nModified", 0)
+            self.logger.error(f"Erro parcial ao atualizar mensagens em lote: {len(details.get('writeErrors', []))} falhas")
+        finally:
+            self._invalidate_conversation_cache(*conversation_oids)
+        
+        # Status das conversas só depois que todas as mensagens foram gravadas
+        try:
+            completed = self.db.diarios.bulk_write(
+                [status_update(conversation_oid) for conversation_oid in conversation_oids],
+                ordered=False
+            ).modified_count
+        except pymongo.errors.BulkWriteError as e:
+            completed = (e.details or {}).get("nModified", 0)
+            self.logger.error(f"Erro parcial ao atualizar status das conversas: {e}")
+        except Exception as e:
+            # Mensagens já gravadas; o status é reavaliado na próxima atualização da conversa
+            completed = 0
+            self.logger.error(f"Erro ao atualizar status das conversas: {e}")
+        
+        return modified, completed
+    
     def update_image_analysis(self, conversation_id: str, contact_idx: int, 
                              message_idx: int, analysis: Dict) -> bool:
         """Atualizar análise de imagem"""
@@ -446,24 +923,22 @@ class DatabaseService(BaseService):
         })
         
         try:
-            result = self.db.diarios.update_one(
-                {"_id": ObjectId(conversation_id)},
-                {
-                    "$set": {
-                        f"contacts.{contact_idx}.messages.{message_idx}.image_analysis": analysis["description"],
-                        f"contacts.{contact_idx}.messages.{message_idx}.image_analysis_data": analysis,
-                        f"contacts.{contact_idx}.messages.{message_idx}.image_analysis_status": "completed",
-                        f"contacts.{contact_idx}.messages.{message_idx}.analyzed_at": datetime.now(),
-                        "updated_at": datetime.now()
-                    }
-                }
-            )
+            # Gravar a análise e reavaliar o status da conversa em um único round trip
+            conversation_oid = self._as_oid(conversation_id)
+            result = self.db.diarios.bulk_write([
+                pymongo.UpdateOne(
+                    {"_id": conversation_oid},
+                    self._image_analysis_update(contact_idx, message_idx, analysis)
+                ),
+                self._image_conversation_status_update(conversation_oid)
+            ])
+            self._invalidate_conversation_cache(conversation_oid)
             
             success = result.modified_count > 0
             
-            # Verificar se todas as imagens da conversa foram processadas
-            if success:
-                self._check_and_update_image_conversation_status(conversation_id)
+            # Segunda operação modificada: todas as imagens da conversa foram processadas
+            if result.modified_count > 1:
+                self.logger.info(f"✅ Conversa {conversation_id} marcada como processada (imagens)")
             
             self._log_success("atualização de análise de imagem", {"modified": result.modified_count})
             return success
@@ -472,33 +947,82 @@ class DatabaseService(BaseService):
             self._log_error("atualização de análise de imagem", e)
             return False
     
+    def update_image_analyses(self, updates: List[Dict]) -> int:
+        """Atualizar várias análises de imagem em lote
+        
+        Cada item contém conversation_id, contact_idx, message_idx e analysis.
+        Mesmo esquema de update_audio_transcriptions: um bulk_write para as
+        mensagens e outro para o status das conversas. Retorna o número de
+        mensagens atualizadas.
+        """
+        if not updates:
+            return 0
+        
+        self._log_operation("atualização de análises de imagem em lote", {"count": len(updates)})
+        
+        try:
+            conversation_oids = [self._as_oid(update["conversation_id"]) for update in updates]
+            message_ops = [
+                pymongo.UpdateOne(
+                    {"_id": conversation_oid},
+                    self._image_analysis_update(update["contact_idx"], update["message_idx"], update["analysis"])
+                )
+                for conversation_oid, update in zip(conversation_oids, updates)
+            ]
+            modified, completed = self._bulk_update_messages(
+                message_ops, conversation_oids, self._image_conversation_status_update
+            )
+            
+            self._log_success("atualização de análises de imagem em lote", {
+                "modified": modified,
+                "conversations_completed": completed
+            })
+            return modified
+            
+        except Exception as e:
+            self._log_error("atualização de análises de imagem em lote", e)
+            return 0
+    
+    def _image_analysis_update(self, contact_idx: int, message_idx: int, analysis: Dict) -> Dict:
+        """Documento de update que grava a análise de imagem de uma mensagem"""
+        prefix = f"contacts.{contact_idx}.messages.{message_idx}"
+        return {
+            "$set": {
+                f"{prefix}.image_analysis": analysis["description"],
+                f"{prefix}.image_analysis_data": analysis,
+                f"{prefix}.image_analysis_status": "completed"
+            },
+            "$currentDate": {f"{prefix}.analyzed_at": True, "updated_at": True}
+        }
+    
+    def _build_image_analysis_doc(self, analysis_data: Dict) -> Dict:
+        """Preparar documento para a collection de análises de imagem (datas via _TIMESTAMPS_UPDATE)"""
+        return {
+            "mensagem_id": analysis_data.get("mensagem_id"),
+            "user_id": analysis_data.get("user_id"),
+            "company_id": analysis_data.get("company_id"),
+            "server_name": analysis_data.get("server_name"),
+            "conversation_id": analysis_data.get("conversation_id"),
+            "contact_name": analysis_data.get("contact_name"),
+            "image_analysis": analysis_data.get("image_analysis", {}),
+            "image_description": analysis_data.get("image_description"),
+            "model": analysis_data.get("model"),
+            "device": analysis_data.get("device"),
+            "file_size": analysis_data.get("file_size"),
+            "generation_time": analysis_data.get("generation_time")
+        }
+    
     def save_image_analysis_to_collection(self, analysis_data: Dict) -> bool:
         """Salvar análise de imagem na collection dedicada"""
         self._ensure_initialized()
         
         try:
-            # Preparar documento para a collection de análises de imagem
-            analysis_doc = {
-                "mensagem_id": analysis_data.get("mensagem_id"),
-                "user_id": analysis_data.get("user_id"),
-                "company_id": analysis_data.get("company_id"),
-                "server_name": analysis_data.get("server_name"),
-                "conversation_id": analysis_data.get("conversation_id"),
-                "contact_name": analysis_data.get("contact_name"),
-                "image_analysis": analysis_data.get("image_analysis", {}),
-                "image_description": analysis_data.get("image_description"),
-                "model": analysis_data.get("model"),
-                "device": analysis_data.get("device"),
-                "file_size": analysis_data.get("file_size"),
-                "generation_time": analysis_data.get("generation_time"),
-                "created_at": datetime.now(),
-                "updated_at": datetime.now()
-            }
+            analysis_doc = self._build_image_analysis_doc(analysis_data)
             
-            # Inserir ou atualizar análise
+            # Inserir ou atualizar análise (datas carimbadas pelo servidor)
             result = self.db.image_analyses.update_one(
                 {"mensagem_id": analysis_doc["mensagem_id"]},
-                {"$set": analysis_doc},
+                {"$set": analysis_doc, "$currentDate": _TIMESTAMPS_UPDATE},
                 upsert=True
             )
             
@@ -514,38 +1038,79 @@ class DatabaseService(BaseService):
             self._log_error("salvamento na collection de análises de imagem", e)
             return False
     
-    def get_image_analysis_stats(self) -> Dict:
-        """Obter estatísticas das análises de imagem"""
+    def save_image_analyses_to_collection(self, analyses: List[Dict]) -> int:
+        """Salvar várias análises de imagem na collection dedicada em uma única ida ao banco"""
         self._ensure_initialized()
         
+        if not analyses:
+            return 0
+        
         try:
-            total = self.db.image_analyses.count_documents({})
+            # Upsert por mensagem_id (índice único) - não ordenado para não parar no primeiro erro
+            operations = [
+                pymongo.UpdateOne(
+                    {"mensagem_id": doc["mensagem_id"]},
+                    {"$set": doc, "$currentDate": _TIMESTAMPS_UPDATE},
+                    upsert=True
+                )
+                for doc in map(self._build_image_analysis_doc, analyses)
+            ]
+            result = self.db.image_analyses.bulk_write(operations, ordered=False)
             
-            # Estatísticas por usuário
-            user_stats = list(self.db.image_analyses.aggregate([
-                {"$group": {
-                    "_id": "$user_id",
-                    "count": {"$sum": 1},
-                    "avg_generation_time": {"$avg": "$generation_time"}
-                }},
-                {"$sort": {"count": -1}},
-                {"$limit": 10}
-            ]))
+            saved = result.upserted_count + result.matched_count
+            self._log_success("salvamento em lote na collection de análises de imagem", {
+                "total": len(operations),
+                "upserted": result.upserted_count,
+                "modified": result.modified_count
+            })
             
-            # Estatísticas por empresa
-            company_stats = list(self.db.image_analyses.aggregate([
-                {"$group": {
-                    "_id": "$company_id",
-                    "count": {"$sum": 1}
-                }},
-                {"$sort": {"count": -1}},
-                {"$limit": 10}
-            ]))
+            return saved
+            
+        except pymongo.errors.BulkWriteError as e:
+            details = e.details or {}
+            saved = details.get("nUpserted", 0) + details.get("nMatched", 0)
+            self.logger.error(f"Erro parcial ao salvar análises de imagem em lote: {len(details.get('writeErrors', []))} falhas")
+            return saved
+        except Exception as e:
+            self.logger.error(f"Erro ao salvar análises de imagem em lote: {e}")
+            return 0
+    
+    def get_image_analysis_stats(self) -> Dict:
+        """Obter estatísticas das análises de imagem"""
+        self._ensure_initialized()
+        
+        try:
+            # Total, usuários e empresas em uma única aggregation, lendo só os campos agrupados
+            result = next(self.db.image_analyses.aggregate([
+                {"$project": {"_id": 0, "user_id": 1, "company_id": 1, "generation_time": 1}},
+                {"$facet": {
+                    "total": [{"$count": "n"}],
+                    # Estatísticas por usuário
+                    "top_users": [
+                        {"$group": {
+                            "_id": "$user_id",
+                            "count": {"$sum": 1},
+                            "avg_generation_time": {"$avg": "$generation_time"}
+                        }},
+                        {"$sort": {"count": -1}},
+                        {"$limit": 10}
+                    ],
+                    # Estatísticas por empresa
+                    "top_companies": [
+                        {"$group": {
+                            "_id": "$company_id",
+                            "count": {"$sum": 1}
+                        }},
+                        {"$sort": {"count": -1}},
+                        {"$limit": 10}
+                    ]
+                }}
+            ]), {})
             
             return {
-                "total_analyses": total,
-                "top_users": user_stats,
-                "top_companies": company_stats
+                "total_analyses": (result.get("total") or [{"n": 0}])[0]["n"],
+                "top_users": result.get("top_users", []),
+                "top_companies": result.get("top_companies", [])
             }
             
         except Exception as e:
@@ -556,85 +1121,47 @@ class DatabaseService(BaseService):
                 "top_companies": []
             }
 
-    def _check_and_update_conversation_status(self, conversation_id: str):
-        """Verificar se todos os áudios da conversa foram processados e atualizar status"""
-        try:
-            # Buscar a conversa
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
-            if not conversation:
-                return
-            
-            # Contar áudios pendentes
-            total_audios = 0
-            processed_audios = 0
-            
-            for contact in conversation.get('contacts', []):
-                for message in contact.get('messages', []):
-                    if self._is_audio_message(message):
-                        total_audios += 1
-                        if message.get('transcription_status') == 'completed':
-                            processed_audios += 1
-            
-            # Se todos os áudios foram processados, marcar conversa como completa
-            if total_audios > 0 and processed_audios == total_audios:
-                self.db.diarios.update_one(
-                    {"_id": ObjectId(conversation_id)},
-                    {
-                        "$set": {
-                            "audio_processing_status": "completed",
-                            "audio_processing_completed_at": datetime.now(),
-                            "audio_processing_stats": {
-                                "total_audios": total_audios,
-                                "processed_audios": processed_audios,
-                                "completion_date": datetime.now()
-                            }
-                        }
-                    }
-                )
-                self.logger.info(f"✅ Conversa {conversation_id} marcada como processada: {processed_audios}/{total_audios} áudios")
-            
-        except Exception as e:
-            self.logger.error(f"Erro ao verificar status da conversa: {e}")
+    def _conversation_status_update(self, conversation_id: Any) -> pymongo.UpdateOne:
+        """Operação que marca a conversa como processada quando todos os áudios têm transcrição"""
+        return self._media_status_update(conversation_id, "audio", _audio_message_expr, "transcription_status")
     
-    def _check_and_update_image_conversation_status(self, conversation_id: str):
-        """Verificar se todas as imagens da conversa foram processadas e atualizar status"""
-        try:
-            # Buscar a conversa
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
-            if not conversation:
-                return
-            
-            # Contar imagens pendentes
-            total_images = 0
-            processed_images = 0
-            
-            for contact in conversation.get('contacts', []):
-                for message in contact.get('messages', []):
-                    if self._is_image_message(message):
-                        total_images += 1
-                        if message.get('image_analysis_status') == 'completed':
-                            processed_images += 1
-            
-            # Se todas as imagens foram processadas, marcar conversa como completa
-            if total_images > 0 and processed_images == total_images:
-                self.db.diarios.update_one(
-                    {"_id": ObjectId(conversation_id)},
-                    {
-                        "$set": {
-                            "image_processing_status": "completed",
-                            "image_processing_completed_at": datetime.now(),
-                            "image_processing_stats": {
-                                "total_images": total_images,
-                                "processed_images": processed_images,
-                                "completion_date": datetime.now()
-                            }
-                        }
+    def _image_conversation_status_update(self, conversation_id: Any) -> pymongo.UpdateOne:
+        """Operação que marca a conversa como processada quando todas as imagens têm análise"""
+        return self._media_status_update(conversation_id, "image", _image_message_expr, "image_analysis_status")
+    
+    def _media_status_update(self, conversation_id: Any, media: str,
+                             message_expr: Callable[[str], Dict], status_field: str) -> pymongo.UpdateOne:
+        """Operação que grava {media}_processing_status = completed quando não há mídia pendente
+        
+        A condição é avaliada no filtro ($expr), sem reler a conversa: se ainda há
+        mensagens pendentes o documento não casa e nada é escrito.
+        """
+        items = _media_items_expr(message_expr)
+        total_field = f"_total_{media}s"
+        
+        return pymongo.UpdateOne(
+            {
+                "_id": self._as_oid(conversation_id),
+                f"{media}_processing_status": {"$ne": "completed"},
+                "$expr": {"$and": [
+                    {"$gt": [{"$size": items}, 0]},
+                    {"$eq": [{"$size": items}, _completed_count_expr(items, status_field)]}
+                ]}
+            },
+            [
+                {"$set": {total_field: {"$size": items}}},
+                {"$set": {
+                    f"{media}_processing_status": "completed",
+                    f"{media}_processing_completed_at": "$$NOW",
+                    f"{media}_processing_stats": {
+                        f"total_{media}s": f"${total_field}",
+                        f"processed_{media}s": f"${total_field}",
+                        "completion_date": "$$NOW"
                     }
-                )
-                self.logger.info(f"✅ Conversa {conversation_id} marcada como processada: {processed_images}/{total_images} imagens")
-            
-        except Exception as e:
-            self.logger.error(f"Erro ao verificar status da conversa: {e}")
+                }},
+                {"$unset": total_field}
+            ]
+        )
     
     def update_conversation_status(self, conversation_id: str, status: str) -> bool:
         """Atualizar status de processamento da conversa"""
@@ -645,12 +1172,10 @@ class DatabaseService(BaseService):
         
         try:
             result = self.db.diarios.update_one(
-                {"_id": ObjectId(conversation_id)},
+                {"_id": self._as_oid(conversation_id)},
                 {
-                    "$set": {
-                        "status_audios": status,
-                        "updated_at": datetime.now()
-                    }
+                    "$set": {"status_audios": status},
+                    "$currentDate": {"updated_at": True}
                 }
             )
             
@@ -663,67 +1188,81 @@ class DatabaseService(BaseService):
             return False
     
     def get_conversation_stats(self) -> Dict[str, Any]:
-        """Obter estatísticas das conversas"""
+        """Obter estatísticas das conversas (cache de STATS_TTL_SECONDS)"""
         self._ensure_initialized()
+        
+        cached = DatabaseService._stats_cache
+        if cached and time.monotonic() - cached[0] < Config.STATS_TTL_SECONDS:
+            return dict(cached[1])
+        
         self._log_operation("obtenção de estatísticas")
         
         try:
-            total_conversations = self.db.diarios.count_documents({})
-            
-            audio_conversations = self.db.diarios.count_documents({
-                "$or": [
-                    {"audio_messages": {"$gt": 0}},
-                    {"media_messages": {"$gt": 0}}
-                ]
-            })
-            
-            # Conversas com áudios pendentes (não processadas)
-            pending_conversations = self.db.diarios.count_documents({
-                "audio_processing_status": {"$ne": "completed"},
-                "$or": [
-                    {"audio_messages": {"$gt": 0}},
-                    {"media_messages": {"$gt": 0}}
-                ]
-            })
-            
-            # Conversas completamente processadas
-            completed_conversations = self.db.diarios.count_documents({
-                "audio_processing_status": "completed"
-            })
+            # Relatório somente leitura: has_audio é gravado na ingestão (update_audio_flag)
+            # e nas transcrições, sem escritas no primário a cada consulta
+            
+            # Os quatro contadores em uma única aggregation
+            facets = {
+                "total_conversations": [],
+                "audio_conversations": [{"$match": {"has_audio": True}}],
+                # Conversas com áudios pendentes (não processadas)
+                "pending_conversations": [{"$match": {
+                    "has_audio": True,
+                    "audio_processing_status": {"$ne": "completed"}
+                }}],
+                # Conversas completamente processadas
+                "completed_conversations": [{"$match": {"audio_processing_status": "completed"}}]
+            }
+            result = next(self._diarios_reports.aggregate([
+                {"$project": {"_id": 1, "has_audio": 1, "audio_processing_status": 1}},
+                {"$facet": {name: stages + [{"$count": "n"}] for name, stages in facets.items()}}
+            ]), {})
             
             stats = {
-                "total_conversations": total_conversations,
-                "audio_conversations": audio_conversations,
-                "pending_conversations": pending_conversations,
-                "completed_conversations": completed_conversations
+                name: (result.get(name) or [{"n": 0}])[0]["n"]
+                for name in facets
             }
             
+            DatabaseService._stats_cache = (time.monotonic(), stats)
             self._log_success("obtenção de estatísticas", stats)
-            return stats
+            return dict(stats)
             
         except Exception as e:
             self._log_error("obtenção de estatísticas", e)
             return {}
 
+    def _invalidate_conversation_cache(self, *conversation_oids: ObjectId):
+        """Descartar textos de análise em cache das conversas alteradas"""
+        with DatabaseService._conversation_cache_lock:
+            for conversation_oid in conversation_oids:
+                DatabaseService._conversation_cache.pop(conversation_oid, None)
+    
+    def _invalidate_stats_cache(self):
+        """Descartar estatísticas em cache (após conversas mudarem de status)"""
+        DatabaseService._stats_cache = None
+    
     def get_processing_status(self, conversation_id: str) -> Dict:
         """Obter status de processamento de uma conversa específica"""
         self._ensure_initialized()
         
         try:
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
+            # Contagens calculadas no servidor: só os totais saem do MongoDB
+            audios = _media_items_expr(_audio_message_expr)
+            conversation = next(self._diarios_reports.aggregate([
+                {"$match": {"_id": self._as_oid(conversation_id)}},
+                {"$project": {
+                    "audio_processing_status": 1,
+                    "audio_processing_completed_at": 1,
+                    "audio_processing_stats": 1,
+                    "total_audios": {"$size": audios},
+                    "processed_audios": _completed_count_expr(audios, "transcription_status")
+                }}
+            ]), None)
             if not conversation:
                 return {"error": "Conversa não encontrada"}
             
-            # Contar áudios
-            total_audios = 0
-            processed_audios = 0
-            
-            for contact in conversation.get('contacts', []):
-                for message in contact.get('messages', []):
-                    if self._is_audio_message(message):
-                        total_audios += 1
-                        if message.get('transcription_status') == 'completed':
-                            processed_audios += 1
+            total_audios = conversation['total_audios']
+            processed_audios = conversation['processed_audios']
             
             status = {
                 "conversation_id": conversation_id,
@@ -742,52 +1281,84 @@ class DatabaseService(BaseService):
             return {"error": str(e)}
     
     def get_conversation_text_for_analysis(self, conversation_id: str) -> Dict:
-        """Obter texto de conversa para análise"""
+        """Obter texto de conversa para análise (cache LRU de CONVERSATION_CACHE_TTL_SECONDS)"""
         self._ensure_initialized()
         try:
-            conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
+            conversation_oid = self._as_oid(conversation_id)
+            cached = self._cached_conversation_text(conversation_oid)
+            if cached is not None:
+                return cached
+            
+            # Montagem das mensagens no servidor: só trafega o texto pronto para análise
+            # (texto, transcrição ou análise de imagem), sem mensagens vazias
+            pipeline = [
+                {"$match": {"_id": conversation_oid}},
+                {"$project": {
+                    "_id": 0,
+                    "user_name": 1,
+                    "date": "$date_formatted",
+                    "contacts": {"$map": {
+                        "input": {"$ifNull": ["$contacts", []]},
+                        "as": "c",
+                        "in": {
+                            "contact_name": "$$c.contact_name",
+                            "messages": {"$filter": {
+                                "input": {"$map": {
+                                    "input": {"$ifNull": ["$$c.messages", []]},
+                                    "as": "m",
+                                    "in": _analysis_message_expr("m")
+                                }},
+                                "as": "x",
+                                "cond": _truthy_expr("$$x.text")
+                            }}
+                        }
+                    }}
+                }}
+            ]
+            conversation = next(self.db.diarios.aggregate(pipeline), None)
             if not conversation:
                 return {}
             
             conversation_text = {
                 'conversation_id': conversation_id,
                 'user_name': conversation.get('user_name'),
-                'date': conversation.get('date_formatted'),
-                'contacts': []
+                'date': conversation.get('date'),
+                'contacts': conversation.get('contacts', [])
             }
             
-            for contact in conversation.get('contacts', []):
-                contact_data = {
-                    'contact_name': contact.get('contact_name'),
-                    'messages': []
-                }
-                
-                for message in contact.get('messages', []):
-                    # Incluir texto da mensagem, transcrição de áudio ou análise de imagem
-                    message_text = self._get_message_content(message)
-                    
-                    if message_text:
-                        message_type = self._get_message_type(message)
-                        contact_data['messages'].append({
-                            'timestamp': message.get('created_at'),
-                            'text': message_text,
-                            'message_type': message_type,
-                            'original_type': message.get('type', message.get('media_type', 'text')),
-                            'has_transcription': bool(message.get('audio_transcription')),
-                            'has_image_analysis': bool(message.get('image_analysis'))
-                        })
-                
-                conversation_text['contacts'].append(contact_data)
-            
             # Adicionar histórico de mensagens dos últimos 7 dias
             conversation_text['historical_context'] = self._get_historical_messages(conversation_id)
             
-            return conversation_text
+            self._cache_conversation_text(conversation_oid, conversation_text)
+            return dict(conversation_text)
             
         except Exception as e:
             self.logger.error(f"Erro ao obter texto da conversa: {e}")
             return {}
     
+    def _cached_conversation_text(self, conversation_oid: ObjectId) -> Optional[Dict]:
+        """Texto de análise em cache, se ainda dentro do TTL"""
+        with DatabaseService._conversation_cache_lock:
+            entry = DatabaseService._conversation_cache.get(conversation_oid)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= Config.CONVERSATION_CACHE_TTL_SECONDS:
+                del DatabaseService._conversation_cache[conversation_oid]
+                return None
+            DatabaseService._conversation_cache.move_to_end(conversation_oid)
+            return dict(entry[1])
+    
+    def _cache_conversation_text(self, conversation_oid: ObjectId, conversation_text: Dict):
+        """Guardar texto de análise no cache, descartando o menos usado quando cheio"""
+        if Config.CONVERSATION_CACHE_TTL_SECONDS <= 0:
+            return
+        with DatabaseService._conversation_cache_lock:
+            cache = DatabaseService._conversation_cache
+            cache[conversation_oid] = (time.monotonic(), conversation_text)
+            cache.move_to_end(conversation_oid)
+            while len(cache) > Config.CONVERSATION_CACHE_MAX_ENTRIES:
+                cache.popitem(last=False)
+    
     def _get_message_content(self, message: Dict) -> str:
         """Obter conteúdo da mensagem priorizando transcrições e análises"""
         # Prioridade: transcrição de áudio > análise de imagem > texto original
@@ -816,16 +1387,6 @@ class DatabaseService(BaseService):
             return 'image'
         return 'text'
     
-    def _is_image_message(self, message: Dict) -> bool:
-        """Verificar se mensagem é imagem"""
-        return (
-            message.get('media_type') == 'image' or
-            message.get('is_image', False) or
-            message.get('type') == 'image' or
-            str(message.get('media_url', '')).endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')) or
-            str(message.get('direct_media_url', '')).endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'))
-        )
-    
     def _get_historical_messages(self, conversation_id: str, days: int = 7) -> List[Dict]:
         """Buscar mensagens históricas dos últimos dias"""
         try:
@@ -836,7 +1397,7 @@ class DatabaseService(BaseService):
             start_date = end_date - timedelta(days=days)
             
             # Buscar conversas dos últimos 7 dias do mesmo usuário
-            current_conversation = self.db.diarios.find_one({"_id": ObjectId(conversation_id)})
+            current_conversation = self.db.diarios.find_one({"_id": self._as_oid(conversation_id)}, {"user_name": 1})
             if not current_conversation:
                 return []
             
@@ -851,7 +1412,7 @@ class DatabaseService(BaseService):
                     '$gte': start_date,
                     '$lt': end_date
                 },
-                '_id': {'$ne': ObjectId(conversation_id)}  # Excluir conversa atual
+                '_id': {'$ne': self._as_oid(conversation_id)}  # Excluir conversa atual
             }).sort('created_at', -1).limit(5)  # Máximo 5 conversas recentes
             
             historical_messages = []
@@ -887,15 +1448,12 @@ class DatabaseService(BaseService):
     def save_conversation_analysis(self, conversation_id: str, analysis: Dict):
         """Salvar análise da conversa no MongoDB (DEPRECATED - usar save_diary_analysis_v2)"""
         try:
-            analysis_data = {
-                'conversation_analysis': analysis,
-                'analyzed_at': datetime.now(),
-                'updated_at': datetime.now()
-            }
-            
             result = self.db.diarios.update_one(
-                {"_id": ObjectId(conversation_id)},
-                {"$set": analysis_data}
+                {"_id": self._as_oid(conversation_id)},
+                {
+                    "$set": {'conversation_analysis': analysis},
+                    "$currentDate": {'analyzed_at': True, 'updated_at': True}
+                }
             )
             
             success = result.modified_count > 0
@@ -915,14 +1473,12 @@ class DatabaseService(BaseService):
                 'contact_analyses': analysis.get('contact_analyses', []),
                 'diary_summary': analysis.get('diary_summary', {}),
                 'analysis_stats': analysis.get('analysis_stats', {}),
-                'analyzed_at': datetime.now(),
-                'updated_at': datetime.now(),
                 'analysis_version': 'v2'
             }
             
             result = self.db.diarios.update_one(
-                {"_id": ObjectId(diary_id)},
-                {"$set": analysis_data}
+                {"_id": self._as_oid(diary_id)},
+                {"$set": analysis_data, "$currentDate": {'analyzed_at': True, 'updated_at': True}}
             )
             
             success = result.modified_count > 0
@@ -938,7 +1494,10 @@ class DatabaseService(BaseService):
         self._ensure_initialized()
         try:
             # Buscar diário
-            diary = self.db.diarios.find_one({"_id": ObjectId(diary_id)})
+            diary = self.db.diarios.find_one(
+                {"_id": self._as_oid(diary_id)},
+                {"user_name": 1, "company_name": 1, "date": 1, "date_formatted": 1, "contacts": 1}
+            )
             if not diary:
                 return None
             
@@ -962,8 +1521,12 @@ class DatabaseService(BaseService):
             self.logger.error(f"Erro ao buscar dados do diário: {e}")
             return None
     
-    def get_diaries_without_analysis_v2(self, limit: int = 100) -> List[Dict]:
-        """Buscar diários sem análise v2"""
+    def get_diaries_without_analysis_v2(self, limit: int = 100, batch_size: int = 10) -> List[Dict]:
+        """Buscar diários sem análise v2
+        
+        Os diários vêm completos (com mensagens), então o cursor busca poucos
+        documentos por lote (batch_size) para limitar a memória do driver.
+        """
         self._ensure_initialized()
         try:
             query = {
@@ -974,7 +1537,7 @@ class DatabaseService(BaseService):
                 ]
             }
             
-            cursor = self.db.diarios.find(query).limit(limit)
+            cursor = self.db.diarios.find(query).limit(limit).batch_size(batch_size)
             diaries = []
             
             for diary in cursor:
@@ -1020,32 +1583,33 @@ class DatabaseService(BaseService):
             self.logger.error(f"Erro ao obter estatísticas v2: {e}")
             return {}
     
+    def _build_transcription_doc(self, transcription_data: Dict) -> Dict:
+        """Preparar documento para a collection de transcrições (datas via _TIMESTAMPS_UPDATE)"""
+        return {
+            "mensagem_id": transcription_data.get("mensagem_id"),
+            "user_id": transcription_data.get("user_id"),
+            "company_id": transcription_data.get("company_id"),
+            "server_name": transcription_data.get("server_name"),
+            "conversation_id": transcription_data.get("conversation_id"),
+            "contact_name": transcription_data.get("contact_name"),
+            "transcription": transcription_data.get("transcription", {}),
+            "audio_duration": transcription_data.get("audio_duration"),
+            "confidence": transcription_data.get("confidence"),
+            "whisper_model": transcription_data.get("whisper_model"),
+            "device": transcription_data.get("device")
+        }
+    
     def save_transcription_to_collection(self, transcription_data: Dict) -> bool:
         """Salvar transcrição na collection dedicada"""
         self._ensure_initialized()
         
         try:
-            # Preparar documento para a collection de transcrições
-            transcription_doc = {
-                "mensagem_id": transcription_data.get("mensagem_id"),
-                "user_id": transcription_data.get("user_id"),
-                "company_id": transcription_data.get("company_id"),
-                "server_name": transcription_data.get("server_name"),
-                "conversation_id": transcription_data.get("conversation_id"),
-                "contact_name": transcription_data.get("contact_name"),
-                "transcription": transcription_data.get("transcription", {}),
-                "audio_duration": transcription_data.get("audio_duration"),
-                "confidence": transcription_data.get("confidence"),
-                "whisper_model": transcription_data.get("whisper_model"),
-                "device": transcription_data.get("device"),
-                "created_at": datetime.now(),
-                "updated_at": datetime.now()
-            }
+            transcription_doc = self._build_transcription_doc(transcription_data)
             
             # Inserir ou atualizar transcrição
             result = self.db.transcriptions.update_one(
                 {"mensagem_id": transcription_doc["mensagem_id"]},
-                {"$set": transcription_doc},
+                {"$set": transcription_doc, "$currentDate": _TIMESTAMPS_UPDATE},
                 upsert=True
             )
             
@@ -1061,6 +1625,43 @@ class DatabaseService(BaseService):
             self.logger.error(f"Erro ao salvar transcrição na collection: {e}")
             return False
     
+    def save_transcriptions_to_collection(self, transcriptions: List[Dict]) -> int:
+        """Salvar várias transcrições na collection dedicada em uma única ida ao banco"""
+        self._ensure_initialized()
+        
+        if not transcriptions:
+            return 0
+        
+        try:
+            # Upsert por mensagem_id (índice único) - não ordenado para não parar no primeiro erro
+            operations = [
+                pymongo.UpdateOne(
+                    {"mensagem_id": doc["mensagem_id"]},
+                    {"$set": doc, "$currentDate": _TIMESTAMPS_UPDATE},
+                    upsert=True
+                )
+                for doc in map(self._build_transcription_doc, transcriptions)
+            ]
+            result = self.db.transcriptions.bulk_write(operations, ordered=False)
+            
+            saved = result.upserted_count + result.matched_count
+            self._log_success("salvamento em lote na collection de transcrições", {
+                "total": len(operations),
+                "upserted": result.upserted_count,
+                "modified": result.modified_count
+            })
+            
+            return saved
+            
+        except pymongo.errors.BulkWriteError as e:
+            details = e.details or {}
+            saved = details.get("nUpserted", 0) + details.get("nMatched", 0)
+            self.logger.error(f"Erro parcial ao salvar transcrições em lote: {len(details.get('writeErrors', []))} falhas")
+            return saved
+        except Exception as e:
+            self.logger.error(f"Erro ao salvar transcrições em lote: {e}")
+            return 0
+    
     def get_transcriptions_by_user(self, user_id: str, limit: int = 100) -> List[Dict]:
         """Buscar transcrições por usuário"""
         self._ensure_initialized()
@@ -1142,6 +1743,7 @@ class DatabaseService(BaseService):
             return {}
     
     def _cleanup(self):
-        """Fechar conexão MongoDB"""
-        if hasattr(self, 'client'):
-            self.client.close()
+        """Liberar referências (o cliente compartilhado é fechado no encerramento do processo)"""
+        self.client = None
+        self.db = None
+        self._diarios_reports = None
@@ -3,13 +3,34 @@ Service para download de arquivos de áudio
 """
 import requests
 import shutil
+from collections import deque
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .base_service import BaseService
 from ..config import Config
 
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.ogg', '.m4a', '.oga')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff')
+
+
+@lru_cache(maxsize=4096)
+def _extension_from_url(url: str, extensions: Tuple[str, ...], default: str) -> str:
+    """Extensão encontrada na URL (função pura, resultado em cache por URL)"""
+    if not url:
+        return default
+    
+    url_lower = url.lower()
+    for ext in extensions:
+        if ext in url_lower:
+            return ext
+    
+    return default
+
+
 class DownloadService(BaseService):
     """Service para download de arquivos"""
     
@@ -49,6 +70,47 @@ class DownloadService(BaseService):
         
         return results
     
+    def prefetch_audio_messages(self, audio_msgs: Iterable[Dict], window: Optional[int] = None,
+                                max_workers: int = 8) -> Iterator[Dict]:
+        """Iterar mensagens de áudio baixando as próximas em paralelo (ordem preservada)
+        
+        Cada mensagem só é entregue após seu download terminar; enquanto o chamador
+        transcreve, até `window` downloads seguintes ficam em andamento.
+        """
+        self._ensure_initialized()
+        window = window or 2 * Config.GPU_BATCH_SIZE
+        messages = iter(audio_msgs)
+        
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download") as executor:
+            in_flight = deque(
+                (audio_msg, executor.submit(self._prefetch_single, audio_msg))
+                for audio_msg in islice(messages, window)
+            )
+            
+            while in_flight:
+                audio_msg, future = in_flight.popleft()
+                future.result()
+                
+                next_msg = next(messages, None)
+                if next_msg is not None:
+                    in_flight.append((next_msg, executor.submit(self._prefetch_single, next_msg)))
+                
+                yield audio_msg
+    
+    def _prefetch_single(self, audio_msg: Dict) -> Optional[str]:
+        """Baixar antecipadamente; falhas ficam para o processamento da mensagem tratar"""
+        if not audio_msg.get('file_url'):
+            return None
+        try:
+            return self.download_audio_file(
+                audio_msg['conversation_id'],
+                str(audio_msg['message_id']),
+                audio_msg['file_url']
+            )
+        except Exception as e:
+            self.logger.warning(f"⚠️ Pré-download falhou para {audio_msg.get('message_id')}: {e}")
+            return None
+    
     def _download_single(self, audio_info: Dict) -> Tuple[Dict, Optional[str]]:
         """Baixar um único áudio"""
         try:
@@ -148,25 +210,11 @@ class DownloadService(BaseService):
     
     def _get_file_extension(self, url: str) -> str:
         """Determinar extensão do arquivo"""
-        if not url:
-            return ".oga"  # Padrão WhatsApp
-        
-        for ext in ['.mp3', '.wav', '.ogg', '.m4a', '.oga']:
-            if ext in url.lower():
-                return ext
-        
-        return ".oga"  # Padrão
+        return _extension_from_url(url, AUDIO_EXTENSIONS, ".oga")  # Padrão WhatsApp
     
     def _get_image_extension(self, url: str) -> str:
         """Determinar extensão da imagem"""
-        if not url:
-            return ".jpg"  # Padrão
-        
-        for ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff']:
-            if ext in url.lower():
-                return ext
-        
-        return ".jpg"  # Padrão
+        return _extension_from_url(url, IMAGE_EXTENSIONS, ".jpg")
     
     def _download_from_url(self, url: str, file_path: Path):
         """Baixar arquivo de URL"""